@@ -0,0 +1,178 @@
+"""
+Importable, non-interactive API for pipelines and workers. Nothing here asks questions, opens a browser or prints
+with rich, and every result is plain lists and dicts that can go straight to JSON or CSV.
+
+    solve(paths)                       Plate solve images ( files or directories ).
+    resolve(names)                     RA / Dec of target names from SIMBAD.
+    pixcoords(solved_image, targets)   Pixel coordinates of RA / Dec values on a plate solved image.
+    comps(solved_image)                Comparison stars from the local star catalog ( see catalog.py ).
+    embed(paths)                       Write solutions into the headers of the original FITS files.
+
+astropy and astroquery are only imported when a function is first called, so importing this module is fast.
+"""
+
+import os
+
+
+def expand_paths(paths):
+    """ Every supported image in a list of files and directories. """
+    from solve import FILE_EXTENSIONS, find_images
+
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            image_paths += find_images(path)
+        elif path.endswith(FILE_EXTENSIONS):
+            image_paths.append(path)
+        else:
+            raise FileNotFoundError(f'{path} is not a directory or supported image.')
+    return image_paths
+
+
+def solve(paths, workers=4, solver='astrometry.net', extract=False, use_cache=True, solve_timeout=None,
+          solve_field='solve-field', config=None, engine='threads', max_upload_mb=None, bin_factor=None, crop=None,
+          upload_format='png', hints=False, embed=False):
+    """
+    Plate solves images and writes every WCS header next to its image ( frame.fits -> frame.wcs ).
+
+    Args:
+        paths (list): Image files and / or directories of images.
+        workers (int, optional): Number of solves kept in flight at once.
+        solver (str, optional): 'astrometry.net' or 'local'.
+        extract (bool, optional): Upload only the positions of the brightest stars instead of whole images.
+        use_cache (bool, optional): Use the local solution cache and submission journal.
+        solve_timeout (int, optional): Seconds to wait on each solve.
+        solve_field (str, optional): solve-field executable for the local solver.
+        config (str, optional): astrometry.cfg for the local solver.
+        engine (str, optional): 'threads' ( a thread per solve in flight ) or 'async' ( every nova.astrometry.net
+            job from one event loop, workers is then the number of uploads at once ).
+        max_upload_mb (float, optional): Bin ( and if needed crop ) FITS images until each upload fits.
+        bin_factor (int, optional): Bin FITS images by this factor before uploading.
+        crop (float, optional): Upload only this central fraction of the width and height.
+        upload_format (str, optional): 'png' or 'fits', format of shrunk uploads.
+        hints (bool, optional): Narrow each solve to the pointing and plate scale in the FITS header.
+        embed (bool, optional): Also write each solution into the header of the original FITS file.
+
+    Returns:
+        list: One dict per image with image, wcs ( path or None ), solved and error.
+    """
+    from batch import solve_many
+    from cache import SolutionCache
+    from journal import SubmissionJournal
+    from preprocess import Preprocessor
+    from solvers import SOLVE_TIMEOUT, LocalSolver
+
+    kwargs = {'max_workers': workers, 'extract': extract, 'solve_timeout': solve_timeout or SOLVE_TIMEOUT,
+              'hints': hints, 'embed': embed}
+    if solver == 'local':
+        kwargs['solver'] = LocalSolver(solve_field=solve_field, config=config)
+    elif solver != 'astrometry.net':
+        raise ValueError(f'Unknown solver {solver}')
+    if use_cache:
+        kwargs['cache'] = SolutionCache()
+        kwargs['journal'] = SubmissionJournal()
+    if max_upload_mb or bin_factor or crop:
+        kwargs['preprocess'] = Preprocessor(max_upload_mb, bin_factor, crop, upload_format)
+
+    errors = {}
+
+    def keep_error(image_path, wcs_path, error):
+        errors[image_path] = error
+
+    if engine == 'async':
+        from async_engine import solve_images
+
+        if solver != 'astrometry.net':
+            raise ValueError('The async engine only solves on nova.astrometry.net')
+        results = solve_images(expand_paths(paths), max_uploads=workers, deadline=kwargs['solve_timeout'],
+                               cache=kwargs.get('cache'), journal=kwargs.get('journal'), extract=extract,
+                               preprocess=kwargs.get('preprocess'), hints=hints, embed=embed,
+                               on_result=keep_error)
+    else:
+        results = solve_many(expand_paths(paths), on_result=keep_error, **kwargs)
+    return [{'image': image, 'wcs': wcs_path, 'solved': wcs_path is not None,
+             'error': str(errors[image]) if errors.get(image) else None}
+            for image, wcs_path in sorted(results.items())]
+
+
+def resolve(names, use_cache=True):
+    """
+    Looks up target names in SIMBAD, all in one query.
+
+    Returns:
+        list: One dict per name with name, main_id, ra and dec ( degrees ). main_id, ra and dec are None for
+        names SIMBAD didn't find.
+    """
+    from resolver import NameCache, resolve as resolve_names
+
+    results = resolve_names(names, cache=NameCache() if use_cache else None)
+    return [results[name] or {'name': name, 'main_id': None, 'ra': None, 'dec': None} for name in names]
+
+
+def pixcoords(solved_image, targets):
+    """
+    Pixel coordinates of many targets on a plate solved image.
+
+    Args:
+        solved_image (str): Plate solved image ( new-image.fits ) or .wcs header.
+        targets (str or list): CSV file with ra and dec columns, or a list of ( name, ra, dec ) tuples.
+
+    Returns:
+        list: One dict per target with name, ra, dec, x, y and in_bounds.
+    """
+    from coords import convert_targets, read_targets
+
+    if isinstance(targets, str):
+        names, ra, dec = read_targets(targets)
+    else:
+        names, ra, dec = (list(column) for column in zip(*targets)) if targets else ([], [], [])
+    return convert_targets(solved_image, names, ra, dec)
+
+
+def comps(solved_image, mag_range=None, count=10, target=None):
+    """
+    Picks comparison stars on a plate solved image from the local star catalog.
+
+    Args:
+        solved_image (str): Plate solved image ( new-image.fits ) or .wcs header.
+        mag_range (tuple, optional): ( brightest, faintest ) magnitude.
+        count (int, optional): Most stars to return.
+        target (tuple, optional): ( ra, dec ) of the target, comparison stars near it are picked first.
+
+    Returns:
+        list: One dict per star with name, ra, dec, mag, x and y.
+    """
+    from catalog import comparison_stars
+    from coords import to_skycoord
+
+    if target is not None:
+        target = to_skycoord([target[0]], [target[1]])[0]
+    return comparison_stars(solved_image, mag_range, count, target)
+
+
+def embed(paths, workers=8, from_cache=False):
+    """
+    Writes the solutions of FITS files ( from the .wcs next to each, or the solution cache ) into their headers.
+
+    Args:
+        paths (list): FITS files and / or directories of them.
+        workers (int, optional): Files worked on at once.
+        from_cache (bool, optional): Look in the solution cache for images without a .wcs next to them.
+
+    Returns:
+        list: One dict per image with image, status ( in_place, rewritten, unchanged, skipped, no_solution or None
+        if it failed ) and error.
+    """
+    from cache import SolutionCache
+    from embed import embed_many
+    from solvers import FITS_EXTENSIONS
+
+    errors = {}
+
+    def keep_error(image_path, status, error):
+        errors[image_path] = error
+
+    image_paths = [path for path in expand_paths(paths) if path.lower().endswith(FITS_EXTENSIONS)]
+    results = embed_many(image_paths, workers, SolutionCache() if from_cache else None, keep_error)
+    return [{'image': image, 'status': status, 'error': str(errors[image]) if errors.get(image) else None}
+            for image, status in sorted(results.items())]
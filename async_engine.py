@@ -0,0 +1,364 @@
+"""
+Asyncio engine for nova.astrometry.net. Uploads, tracks and polls many submissions from a single event loop over
+one shared HTTP connection pool, so hundreds of jobs can be in flight without a thread ( or a blocked astroquery
+call ) per image.
+
+Polling starts fast and backs off exponentially while a job isn't making progress, dropping back to the fastest
+rate whenever it does ( for example when the submission is picked up by a solver ). Every job has its own deadline.
+
+Needs aiohttp ( pip install aiohttp ).
+
+Usage:
+    python async_engine.py /path/to/night --uploads 4 --deadline 1800
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+import metrics
+from astropy.io import fits
+from batch import add_preprocess_arguments, preprocessor_from_args, print_result
+from cache import SolutionCache, image_hash
+from embed import embed_wcs
+from hints import TargetLookup, for_upload, solve_hints
+from journal import SubmissionJournal
+from solve import find_images, write_wcs
+from solvers import API_KEY, ASTROMETRY_NET_URL, FITS_EXTENSIONS
+from sources import extract_from_file
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# * Polling intervals in seconds, and how much the interval grows after every poll without progress.
+MIN_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 60.0
+POLL_BACKOFF = 1.5
+
+# * Seconds a job may take from upload to solution, uploads allowed at once, and HTTP connections kept open.
+DEADLINE = 1800
+MAX_UPLOADS = 4
+MAX_CONNECTIONS = 20
+
+# * Images shrunk at once with --bin / --crop / --max-upload-mb. Every one of them is a full frame in memory.
+MAX_PREPARES = 4
+
+
+class AstrometryNetError(RuntimeError):
+    """ nova.astrometry.net answered with an error. """
+
+
+class AsyncAstrometryNet():
+    """
+    Minimal asyncio client for the nova.astrometry.net API, sharing one aiohttp session between every job.
+    """
+
+    def __init__(self, session, api_key=API_KEY, url=ASTROMETRY_NET_URL):
+        self.http = session
+        self.api_key = api_key
+        self.url = url
+        self.api_url = f'{url}/api'
+        self._session_id = None
+        self._login_lock = asyncio.Lock()
+
+    async def _post(self, path, settings, data=None):
+        #  Settings always go in a request-json field, an image goes next to it as a multipart file.
+        form = {'request-json': json.dumps(settings)}
+        if data is not None:
+            form = aiohttp.FormData(form)
+            form.add_field('file', data, filename='image', content_type='application/octet-stream')
+
+        async with self.http.post(f'{self.api_url}/{path}', data=form) as response:
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+        if result.get('status') == 'error':
+            raise AstrometryNetError(result.get('errormessage', f'{path} failed'))
+        return result
+
+    async def _get_json(self, path):
+        async with self.http.get(f'{self.api_url}/{path}') as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def login(self):
+        """ Logs in once, however many jobs ask for it at the same time. """
+        async with self._login_lock:
+            if self._session_id is None:
+                result = await self._post('login', {'apikey': self.api_key})
+                self._session_id = result['session']
+        return self._session_id
+
+    async def upload_image(self, image_path, settings=None):
+        """ Uploads a whole image with optional solve settings ( see hints.py ) and returns its submission ID. """
+        session_id = await self.login()
+        data = await asyncio.to_thread(_read_bytes, image_path)
+        result = await self._post('upload', {**(settings or {}), 'session': session_id}, data=data)
+        return result['subid']
+
+    async def upload_sources(self, x, y, width, height, settings=None):
+        """ Uploads a star list with optional solve settings and returns its submission ID. """
+        session_id = await self.login()
+        settings = {**(settings or {}), 'session': session_id, 'x': [float(v) for v in x],
+                    'y': [float(v) for v in y], 'image_width': int(width), 'image_height': int(height)}
+        result = await self._post('url_upload', settings)
+        return result['subid']
+
+    async def submission_job(self, submission_id):
+        """ Job ID of a submission, or None while it is still queued. """
+        result = await self._get_json(f'submissions/{submission_id}')
+        jobs = [job for job in result.get('jobs', []) if job is not None]
+        return jobs[0] if jobs else None
+
+    async def job_status(self, job_id):
+        """ 'success', 'failure' or 'solving'. """
+        result = await self._get_json(f'jobs/{job_id}')
+        return result.get('status')
+
+    async def wcs_header(self, job_id):
+        """ WCS header of a solved job. """
+        async with self.http.get(f'{self.url}/wcs_file/{job_id}') as response:
+            response.raise_for_status()
+            text = await response.text(errors='replace')
+        return fits.Header.fromstring(text)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def poll_submission(client, submission_id, deadline):
+    """
+    Waits for a submission to finish, polling with adaptive exponential backoff.
+
+    Args:
+        client (AsyncAstrometryNet): Shared client.
+        submission_id (int): Submission ID from an upload.
+        deadline (float): time.monotonic() value to give up at.
+
+    Returns:
+        astropy.io.fits.Header: WCS header of the solution, or an empty result if the solve failed.
+    """
+    interval = MIN_POLL_INTERVAL
+    job_id = None
+    last_status = None
+    #  Time in the queue runs until the submission gets a job, time solving from then until it finishes.
+    stage_start = time.perf_counter()
+
+    while True:
+        #  Spreads polls out a little so hundreds of jobs don't all hit the server at the same moment.
+        wait = min(interval, max(deadline - time.monotonic(), 0)) * random.uniform(0.8, 1.2)
+        await asyncio.sleep(wait)
+        if time.monotonic() > deadline:
+            metrics.count('timeouts')
+            metrics.observe('solve' if job_id else 'queue_wait', time.perf_counter() - stage_start,
+                            error='TimeoutError', submission_id=submission_id, job_id=job_id)
+            raise TimeoutError('Solve timed out without success or failure', submission_id)
+
+        progressed = False
+        status = None
+        try:
+            if job_id is None:
+                job_id = await client.submission_job(submission_id)
+                progressed = job_id is not None
+                if job_id is not None:
+                    metrics.observe('queue_wait', time.perf_counter() - stage_start, submission_id=submission_id,
+                                    job_id=job_id)
+                    stage_start = time.perf_counter()
+            if job_id is not None:
+                status = await client.job_status(job_id)
+                progressed = progressed or status != last_status
+                last_status = status
+        except aiohttp.ClientResponseError as e:
+            # * Server is busy or having a moment, back off harder and try again.
+            if e.status == 429 or e.status >= 500:
+                metrics.count('retries')
+                interval = min(interval * POLL_BACKOFF * 2, MAX_POLL_INTERVAL)
+                continue
+            raise
+
+        if status in ('success', 'failure'):
+            metrics.observe('solve', time.perf_counter() - stage_start, submission_id=submission_id,
+                            job_id=job_id, solved=status == 'success')
+        if status == 'success':
+            with metrics.stage('wcs_download', job_id=job_id):
+                return await client.wcs_header(job_id)
+        if status == 'failure':
+            return {}
+
+        # * Progress means the job is moving, so look again soon, otherwise wait longer every time.
+        interval = MIN_POLL_INTERVAL if progressed else min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+
+async def solve_one(client, image_path, upload_slots, deadline=DEADLINE, cache=None, journal=None, extract=False,
+                    preprocess=None, hints=None, prepare_slots=None, target_lookup=None):
+    """
+    Solves one image: cache check, upload ( or journaled submission ), polling and cache update.
+
+    The deadline starts once the submission ID is known, so time spent waiting for an upload slot doesn't count.
+    With preprocess the image is shrunk before the upload ( holding one of prepare_slots, if given ) and the
+    solution mapped back onto the original. hints works as in solve.solve_image(), a hinted job that fails is tried
+    again blind with a deadline of its own, and target_lookup shares its SIMBAD lookups with the other jobs.
+
+    Returns:
+        astropy.io.fits.Header: WCS header of the solution, or an empty result if the solve failed.
+    """
+    key = None
+    if cache is not None or journal is not None:
+        key = await asyncio.to_thread(image_hash, image_path)
+
+    if cache is not None:
+        wcs_header = await asyncio.to_thread(cache.get, key)
+        metrics.count('cache_misses' if wcs_header is None else 'cache_hits')
+        if wcs_header is not None:
+            return wcs_header
+
+    with tempfile.TemporaryDirectory(prefix='autoastrometry-upload-') as upload_dir:
+        upload_path, transform = image_path, None
+        if preprocess is not None:
+            async with prepare_slots or asyncio.Semaphore():
+                upload_path, transform = await asyncio.to_thread(preprocess.prepare, image_path, upload_dir)
+        journal_key = key if transform is None else f'{key}:{transform.signature()}'
+
+        if hints is True:
+            settings = await asyncio.to_thread(solve_hints, image_path, lookup=target_lookup)
+        else:
+            settings = dict(hints or {})
+        if transform is not None:
+            settings = for_upload(settings, transform.factor)
+
+        wcs_header = await _submit_and_poll(client, image_path, upload_path, upload_slots, deadline, journal,
+                                            journal_key, extract, settings)
+        if not wcs_header and settings:
+            metrics.count('blind_retries')
+            wcs_header = await _submit_and_poll(client, image_path, upload_path, upload_slots, deadline, journal,
+                                                journal_key, extract, None)
+
+    if transform is not None:
+        wcs_header = transform.to_original(wcs_header)
+    if wcs_header and cache is not None:
+        await asyncio.to_thread(cache.put, key, wcs_header)
+    return wcs_header
+
+
+async def _submit_and_poll(client, image_path, upload_path, upload_slots, deadline, journal, journal_key, extract,
+                           settings):
+    submission_id = None
+    if journal is not None:
+        submission_id = await asyncio.to_thread(journal.pending_submission, journal_key)
+    if not submission_id:
+        #  Uploads are the only heavy part, so only a few of them run at once.
+        async with upload_slots:
+            with metrics.stage('upload', image=image_path, extract=extract, hinted=bool(settings)) as fields:
+                if extract and upload_path.lower().endswith(FITS_EXTENSIONS):
+                    x, y, width, height = await asyncio.to_thread(extract_from_file, upload_path)
+                    submission_id = await client.upload_sources(x, y, width, height, settings)
+                else:
+                    submission_id = await client.upload_image(upload_path, settings)
+                fields['submission_id'] = submission_id
+            metrics.count('submissions')
+        if journal is not None:
+            await asyncio.to_thread(journal.record, journal_key, image_path, submission_id)
+
+    wcs_header = await poll_submission(client, submission_id, time.monotonic() + deadline)
+
+    if journal is not None:
+        await asyncio.to_thread(journal.finish, journal_key, bool(wcs_header))
+    return wcs_header
+
+
+async def solve_all(image_paths, api_key=API_KEY, max_uploads=MAX_UPLOADS, deadline=DEADLINE, cache=None,
+                    journal=None, extract=False, preprocess=None, hints=None, embed=False, url=ASTROMETRY_NET_URL,
+                    on_result=None):
+    """
+    Solves many images concurrently from one event loop and writes every WCS header next to its image.
+
+    Args:
+        image_paths (list): Paths to the images.
+        api_key (str, optional): nova.astrometry.net API key.
+        max_uploads (int, optional): Uploads allowed at once. Polling isn't limited.
+        deadline (int, optional): Seconds each job may take from upload to solution.
+        cache (cache.SolutionCache, optional): Solution cache checked before anything is uploaded.
+        journal (journal.SubmissionJournal, optional): Submission journal for resuming interrupted runs.
+        extract (bool, optional): Upload only the positions of the brightest stars instead of whole images.
+        preprocess (preprocess.Preprocessor, optional): Shrinks every image before it is uploaded.
+        hints (bool or dict, optional): Solve hints for every image, see solve.solve_image().
+        embed (bool, optional): Also write every solution into the header of its FITS file.
+        url (str, optional): Base URL of the astrometry.net server.
+        on_result (callable, optional): Called as on_result(image_path, wcs_path, error) as each job finishes.
+
+    Returns:
+        dict: Maps every image path to its WCS header path, or None if it could not be solved.
+    """
+    if aiohttp is None:
+        raise ImportError('The asyncio engine needs aiohttp ( pip install aiohttp ).')
+
+    results = {}
+    upload_slots = asyncio.Semaphore(max_uploads)
+    prepare_slots = asyncio.Semaphore(MAX_PREPARES)
+    target_lookup = TargetLookup() if hints is True else None
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        client = AsyncAstrometryNet(session, api_key=api_key, url=url)
+
+        async def run(image_path):
+            wcs_path = error = None
+            try:
+                wcs_header = await solve_one(client, image_path, upload_slots, deadline, cache, journal, extract,
+                                             preprocess, hints, prepare_slots, target_lookup)
+                if wcs_header:
+                    if embed:
+                        await asyncio.to_thread(embed_wcs, image_path, wcs_header)
+                    wcs_path = await asyncio.to_thread(write_wcs, wcs_header, image_path)
+            except Exception as e:
+                error = e
+            results[image_path] = wcs_path
+            if on_result:
+                on_result(image_path, wcs_path, error)
+
+        await asyncio.gather(*(run(image_path) for image_path in image_paths))
+    return results
+
+
+def solve_images(image_paths, **kwargs):
+    """ Blocking wrapper around solve_all() for code that isn't async. """
+    return asyncio.run(solve_all(image_paths, **kwargs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plate solve every image in a directory from one event loop.')
+    parser.add_argument('directory', help='Directory holding the images to solve.')
+    parser.add_argument('--uploads', type=int, default=MAX_UPLOADS,
+                        help=f'Uploads allowed at once ( default: {MAX_UPLOADS} ).')
+    parser.add_argument('--deadline', type=int, default=DEADLINE,
+                        help=f'Seconds each job may take ( default: {DEADLINE} ).')
+    parser.add_argument('--extract', action='store_true',
+                        help='Find stars locally and upload only their positions instead of whole images.')
+    parser.add_argument('--hints', action='store_true',
+                        help='Narrow each solve to the pointing and plate scale in the FITS header.')
+    parser.add_argument('--embed', action='store_true',
+                        help='Also write each solution into the header of the original FITS file.')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the solution cache and submission journal.')
+    add_preprocess_arguments(parser)
+    args = parser.parse_args(argv)
+
+    cache = journal = None
+    if not args.no_cache:
+        cache, journal = SolutionCache(), SubmissionJournal()
+    results = solve_images(find_images(args.directory), max_uploads=args.uploads, deadline=args.deadline,
+                           cache=cache, journal=journal, extract=args.extract,
+                           preprocess=preprocessor_from_args(args), hints=args.hints, embed=args.embed,
+                           on_result=print_result)
+    solved = sum(1 for wcs_path in results.values() if wcs_path)
+    print(f'\nSolved {solved} of {len(results)} images.')
+    return 0 if solved == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
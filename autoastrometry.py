@@ -6,13 +6,17 @@ those coordinates to pixel coordinates within the image and get them back to you
 
 import os
 import webbrowser
+import metrics
 from astropy.wcs.wcsapi.fitswcs import SlicedFITSWCS
-from astroquery.astrometry_net import AstrometryNet
-from astroquery.simbad import Simbad
 from rich import print
 from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.wcs import WCS
+from cache import SolutionCache
+from catalog import comparison_stars, has_index
+from coords import convert_targets, load_wcs, read_targets
+from embed import SKIPPED, embed_wcs
+from journal import SubmissionJournal
+from resolver import NameCache, resolve
+from solve import FILE_EXTENSIONS, solve_image
 
 # Helper functions ( basically everything outside the FITSU class )
 
@@ -80,10 +84,14 @@ def simbad_query():
         #  Asks for target name and tries to look it up then if it can, prints it out.
         target = ask_for('\nTarget name: ')
         target = target.strip(' ')
-        query = Simbad.query_object(f'{target}')
+        target_info = resolve([target], cache=NameCache())[target]
+        if target_info is None:
+            raise LookupError(f'{target} was not found')
+        coord = SkyCoord(target_info['ra'], target_info['dec'], unit='deg')
         print('\n*********************************************************************************************************************************************')
         print('[bold blue]Target info[/]:')
-        query.pprint()
+        print(f"{target_info['main_id']}  RA: {coord.ra.to_string(unit='hourangle', sep=' ', precision=2)}  "
+              f"Dec: {coord.dec.to_string(sep=' ', precision=1, alwayssign=True)}")
         print('*********************************************************************************************************************************************')
 
         #  Asks the user if they wanted to be redirected to the website.
@@ -110,8 +118,7 @@ def find_image():
         dir_or_file = ask_for('\n: ', _type=str)
 
         # * Supported file extensions (mainly those just supported by astrometry.net)
-        file_extensions = ['.FITS', '.JPEG', '.PNG',
-                           '.FIT', '.fits', '.fit', '.fts']
+        file_extensions = FILE_EXTENSIONS
 
         #  File counter
         counter = 0
@@ -167,37 +174,36 @@ class FITSUploader():
     def __init__(self, image_path):
         self.image_path = image_path
 
-    def upload_file(self):
+    def solve(self):
+        """
+        Solves the image without any prompts and returns the WCS header. Solutions are cached on disk and the
+        submission is journaled, so an interrupted solve is picked back up instead of uploaded again. The pointing
+        and plate scale in the FITS header narrow the search, with a blind solve if they turn out to be wrong.
+        """
+        return solve_image(self.image_path, cache=SolutionCache(), journal=SubmissionJournal(), hints=True)
 
-        #  Creating instance of astrometry.net and API key
-        ast = AstrometryNet()
-        ast.api_key = 'bchkvzadjuswddhg'
+    def upload_file(self):
 
-        try_again = True
-        submission_id = None
-
-        while try_again:
-            try:
-                if not submission_id:
-                    # Solves the image from the file path
-                    wcs_header = ast.solve_from_image(f'{self.image_path}', force_image_upload=True,
-                                                      submission_id=submission_id, solve_timeout=1000)
-                else:
-                    #  Time is in seconds.
-                    wcs_header = ast.monitor_submission(
-                        submission_id, solve_timeout=1000)
-            except TimeoutError as e:
-                #  Timeout error, never triggers. Basically useless code since it never triggers during timeout error
-                submission_id = e.args[1]
-                print('\nThere was a timeout error. ( Process took to long ).')
-                print('Astometry.net could also be down at the moment.')
-            else:
-                #! got a result, so terminate
-                try_again = False
+        try:
+            wcs_header = self.solve()
+        except TimeoutError:
+            print('\n[bold red]Timed out[/bold red] waiting for the solve. It is still pending, run '
+                  '"python journal.py --resume" to pick it up later.')
+            return
 
         if wcs_header:
             #  Code to execute when solve succeeds
             print('\nSuccess! :thumbs_up:')
+
+            # * Keeps the solution in the frame itself, so it can be used for pixel coordinates instead of new-image.fits.
+            if self.image_path.lower().endswith(('.fits', '.fit', '.fts')):
+                keep = ask_for(f'\nWrite the solution into the header of {self.image_path}? (y/n): ',
+                               'Not a yes or no', str).lower()
+                if keep[0] == 'y':
+                    if embed_wcs(self.image_path, wcs_header) == SKIPPED:
+                        print("[red]Tile compressed images can't be updated[/], use new-image.fits instead.")
+                    else:
+                        print('Solution written, you can use this image for pixel coordinates.')
             print(
                 '\nTo get the most possible information out of your image please visit the website below.')
             redirect_to('http://nova.astrometry.net/users/20995')
@@ -253,6 +259,7 @@ class FITSUploader():
                 not_radec = False
 
         def pixel_pos():
+            filename = solved_image
             not_image = True
             while not_image:
                 try:
@@ -260,41 +267,68 @@ class FITSUploader():
                     print('\n*********************************************************************************************************************************************')
                     print(
                         'Please put in the [bold blue]plate solved image[/] from https://nova.astrometry.net.')
-                    print('It should be titled [bold blue]new-image.fits[/].')
+                    print('It should be titled [bold blue]new-image.fits[/], or use your own image if the solution was written into it.')
                     print('*********************************************************************************************************************************************')
 
-                    filename = solved_image
+                    #  Reads only the header ( the file is closed straight away ) and applies WCS to it ( world coordinate system ).
+                    wcs, _ = load_wcs(filename)
 
-                    # Opens the file and looks at header data
-                    hdu = fits.open(filename)
-                    header = hdu[0].header
-
-                    #  Applies WCS to header ( world coordinate system ). Also checks that the RA and Dec values are in fk5.
-                    wcs = WCS(header)
+                    #  Also checks that the RA and Dec values are in fk5.
                     coord = SkyCoord(
                         f'{ra1}h{ra2}m{ra3}s {dec1}d{dec2}m{dec3}s', frame='fk5')
 
                     # * Converts the RA and Dec values to pixel values within the image. It then also prints them out.
-                    px = wcs.world_to_pixel(coord)
+                    with metrics.stage('pixel_coords', targets=1):
+                        px = wcs.world_to_pixel(coord)
                     print('\n*********************************************************************************************************************************************')
                     print('Pixel coordinates:')
                     print(px)
                     print('*********************************************************************************************************************************************')
                     return px
 
-                except:
+                except (OSError, ValueError) as e:
                     #  File that was given was not the plate solved image from https://nova.astrometry.net.
+                    print(f'\n[red]{e}[/]')
                     print(
                         '\nPlease put in the [bold blue]plate solved image[/] from https://nova.astrometry.net.')
-                else:
-                    # Got correct result so break out of loop
-                    not_image = False
+                    filename = find_image()
         pixel_pos()
 
     def check_comp_stars(self):
         comp_stars = ask_for(
             '\nDo you have any comparison stars you would like to get the pixel coordinates from? (y/n): ', 'Not a yes or no', str).lower()
         if comp_stars[0] == 'y':
+            if has_index():
+                from_catalog = ask_for(
+                    '\nPick them automatically from the local star catalog? (y/n): ', 'Not a yes or no', str).lower()
+                if from_catalog[0] == 'y':
+                    # * Finds every suitable star on the image in one go, no typing or network needed.
+                    brightest = ask_for('\nBrightest magnitude to use: ', 'Not a number.', float)
+                    faintest = ask_for('Faintest magnitude to use: ', 'Not a number.', float)
+                    print('\n[bold blue]Plate solved image[/] ( new-image.fits ):')
+                    rows = comparison_stars(find_image(), (brightest, faintest))
+                    print('\n*********************************************************************************************************************************************')
+                    for row in rows:
+                        print(f"{row['name']} ( mag {row['mag']:.2f} ): ({row['x']:.2f}, {row['y']:.2f})")
+                    if not rows:
+                        print('[red]No catalog stars in that magnitude range on the image.[/]')
+                    print('*********************************************************************************************************************************************')
+                    return
+
+            from_csv = ask_for(
+                '\nAre they in a CSV file with ra and dec columns? (y/n): ', 'Not a yes or no', str).lower()
+            if from_csv[0] == 'y':
+                # * Converts every star in the file at once.
+                csv_path = ask_for('\nPath to the CSV file: ', _type=str)
+                print('\n[bold blue]Plate solved image[/] ( new-image.fits ):')
+                rows = convert_targets(find_image(), *read_targets(csv_path))
+                print('\n*********************************************************************************************************************************************')
+                for row in rows:
+                    where = '' if row['in_bounds'] else '  [red]( outside the image )[/]'
+                    print(f"{row['name']}: ({row['x']:.2f}, {row['y']:.2f}){where}")
+                print('*********************************************************************************************************************************************')
+                return
+
             num_comp_stars = ask_for(
                 '\nHow many comparison stars do you have? ( Integer )', 'Not an integer.', int)
             counter = 0
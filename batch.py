@@ -0,0 +1,173 @@
+"""
+Batch plate solving. Submits every supported image in a directory to nova.astrometry.net with a bounded number
+of solves in flight at once, then writes each solved WCS header next to its source image.
+
+Usage:
+    python batch.py /path/to/night --workers 8
+"""
+
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import CACHE_DIR, SolutionCache
+from embed import embed_wcs
+from hints import TargetLookup
+from journal import JOURNAL_PATH, SubmissionJournal
+from preprocess import FORMATS, Preprocessor
+from solve import API_KEY, SOLVE_TIMEOUT, find_images, solve_image, write_wcs
+from solvers import SOLVERS, LocalSolver
+
+
+def solve_and_write(image_path, api_key=API_KEY, solve_timeout=SOLVE_TIMEOUT, cache=None, journal=None,
+                    extract=False, solver=None, preprocess=None, hints=None, embed=False, target_lookup=None):
+    """
+    Solves one image ( or finds it in the cache ) and writes its WCS header next to it, and with embed into the
+    header of the image itself ( see embed.py ).
+
+    Returns:
+        str: Path of the written WCS header, or None if the solve failed.
+    """
+    wcs_header = solve_image(image_path, api_key=api_key, solve_timeout=solve_timeout, cache=cache,
+                             journal=journal, extract=extract, solver=solver, preprocess=preprocess, hints=hints,
+                             target_lookup=target_lookup)
+    if not wcs_header:
+        return None
+    if embed:
+        embed_wcs(image_path, wcs_header)
+    #  Written after the image, so the .wcs stays the newer file and watch.py knows the frame is done.
+    return write_wcs(wcs_header, image_path)
+
+
+def solve_many(image_paths, max_workers=4, api_key=API_KEY, solve_timeout=SOLVE_TIMEOUT, cache=None,
+               journal=None, extract=False, solver=None, preprocess=None, hints=None, embed=False, on_result=None):
+    """
+    Solves a list of images, keeping at most max_workers submissions in flight.
+
+    Args:
+        image_paths (list): Paths to the images.
+        max_workers (int, optional): Number of submissions allowed in flight at once.
+        api_key (str, optional): nova.astrometry.net API key.
+        solve_timeout (int, optional): Seconds to wait on each solve.
+        cache (cache.SolutionCache, optional): Solution cache checked before anything is uploaded.
+        journal (journal.SubmissionJournal, optional): Submission journal, so an interrupted batch can be rerun
+            without uploading the images that were already submitted.
+        extract (bool, optional): Upload only the positions of the brightest stars instead of whole images.
+        solver (solvers.Solver, optional): Solver backend shared by every image. Defaults to a separate
+            nova.astrometry.net client per image.
+        preprocess (preprocess.Preprocessor, optional): Shrinks every image before it is uploaded.
+        hints (bool or dict, optional): Solve hints for every image, see solve.solve_image().
+        embed (bool, optional): Also write every solution into the header of its FITS file.
+        on_result (callable, optional): Called as on_result(image_path, wcs_path, error) as each solve finishes.
+
+    Returns:
+        dict: Maps every image path to its WCS header path, or None if it could not be solved.
+    """
+    results = {}
+    #  Every frame of a night usually has the same OBJECT, so SIMBAD is asked once for the whole batch.
+    target_lookup = TargetLookup() if hints is True else None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(solve_and_write, image_path, api_key, solve_timeout, cache, journal, extract, solver,
+                        preprocess, hints, embed, target_lookup): image_path for image_path in image_paths}
+
+        # * Collects results in the order they finish, not the order they were submitted.
+        for future in as_completed(futures):
+            image_path = futures[future]
+            error = None
+            try:
+                wcs_path = future.result()
+            except Exception as e:
+                wcs_path = None
+                error = e
+            results[image_path] = wcs_path
+            if on_result:
+                on_result(image_path, wcs_path, error)
+    return results
+
+
+def batch_solve(directory, max_workers=4, **kwargs):
+    """
+    Solves every supported image in a directory, keeping at most max_workers submissions in flight.
+
+    Args:
+        directory (str): Directory holding the images.
+        max_workers (int, optional): Number of submissions allowed in flight at once.
+        **kwargs: Passed to solve_many().
+
+    Returns:
+        dict: Maps every image path to its WCS header path, or None if it could not be solved.
+    """
+    return solve_many(find_images(directory), max_workers=max_workers, **kwargs)
+
+
+def print_result(image_path, wcs_path, error):
+    """ Prints one line per finished image. """
+    if error:
+        print(f'FAILED  {image_path}: {error}')
+    elif wcs_path:
+        print(f'SOLVED  {image_path} -> {wcs_path}')
+    else:
+        print(f'FAILED  {image_path}: no solution')
+
+
+def add_preprocess_arguments(parser):
+    """ Upload shrinking options shared by the batch command lines. """
+    parser.add_argument('--max-upload-mb', type=float,
+                        help='Bin ( and if needed crop ) FITS images until each upload is under this many MiB.')
+    parser.add_argument('--bin', type=int, help='Bin FITS images by this factor before uploading.')
+    parser.add_argument('--crop', type=float, help='Upload only this central fraction of the width and height.')
+    parser.add_argument('--upload-format', choices=FORMATS, default='png',
+                        help='Format of shrunk uploads, 8 bit PNG or Rice compressed FITS ( default: png ).')
+
+
+def preprocessor_from_args(args):
+    """ Preprocessor for the add_preprocess_arguments() options, or None if none were given. """
+    if not (args.max_upload_mb or args.bin or args.crop):
+        return None
+    return Preprocessor(args.max_upload_mb, args.bin, args.crop, args.upload_format)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plate solve every image in a directory.')
+    parser.add_argument('directory', help='Directory holding the images to solve.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of submissions kept in flight at once ( default: 4 ).')
+    parser.add_argument('--timeout', type=int, default=SOLVE_TIMEOUT,
+                        help=f'Seconds to wait on each solve ( default: {SOLVE_TIMEOUT} ).')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f'Plate solution cache directory ( default: {CACHE_DIR} ).')
+    parser.add_argument('--no-cache', action='store_true', help='Always upload, ignoring cached solutions.')
+    parser.add_argument('--journal', default=JOURNAL_PATH,
+                        help=f'Submission journal used to resume interrupted runs ( default: {JOURNAL_PATH} ).')
+    parser.add_argument('--extract', action='store_true',
+                        help='Find stars locally and upload only their positions instead of whole images.')
+    parser.add_argument('--solver', choices=sorted(SOLVERS), default='astrometry.net',
+                        help='Solve on nova.astrometry.net or with a local solve-field ( default: astrometry.net ).')
+    parser.add_argument('--solve-field', default='solve-field', help='solve-field executable for --solver local.')
+    parser.add_argument('--config', help='astrometry.cfg listing the index files for --solver local.')
+    parser.add_argument('--hints', action='store_true',
+                        help='Narrow each solve to the pointing and plate scale in the FITS header.')
+    parser.add_argument('--embed', action='store_true',
+                        help='Also write each solution into the header of the original FITS file.')
+    add_preprocess_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # * Every local solve is its own process, so one LocalSolver can be shared by all the workers.
+    solver = None
+    if args.solver == 'local':
+        solver = LocalSolver(solve_field=args.solve_field, config=args.config)
+
+    cache = None if args.no_cache else SolutionCache(args.cache_dir)
+    results = batch_solve(args.directory, max_workers=args.workers, solve_timeout=args.timeout, cache=cache,
+                          journal=SubmissionJournal(args.journal), extract=args.extract,
+                          solver=solver, preprocess=preprocessor_from_args(args), hints=args.hints,
+                          embed=args.embed, on_result=print_result)
+    solved = sum(1 for wcs_path in results.values() if wcs_path)
+    print(f'\nSolved {solved} of {len(results)} images.')
+
+    # * Non-zero exit code if anything failed so it can be used in scripts.
+    return 0 if solved == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Compares uploading whole images against uploading only a locally extracted star list.
+
+For every FITS file it reports the bytes that would be sent each way and the time spent extracting sources.
+With --live it also solves every image both ways on nova.astrometry.net and reports the end-to-end times.
+
+Usage:
+    python benchmarks/bench_source_upload.py /path/to/images
+    python benchmarks/bench_source_upload.py /path/to/images --live
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from solve import find_images, solve_image  # noqa: E402
+from solvers import FITS_EXTENSIONS  # noqa: E402
+from sources import N_BRIGHTEST, extract_from_file  # noqa: E402
+
+
+def source_list_bytes(x, y, width, height):
+    """ Size of the request astroquery sends for a source list solve. """
+    settings = {'x': [float(v) for v in x], 'y': [float(v) for v in y],
+                'image_width': width, 'image_height': height}
+    return len(json.dumps(settings).encode())
+
+
+def timed_solve(image_path, extract):
+    """ End-to-end seconds for one solve, and whether it succeeded. """
+    start = time.perf_counter()
+    wcs_header = solve_image(image_path, extract=extract)
+    return time.perf_counter() - start, bool(wcs_header)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark full image upload against star list upload.')
+    parser.add_argument('directory', help='Directory holding FITS images.')
+    parser.add_argument('--n-brightest', type=int, default=N_BRIGHTEST, help='Number of stars to upload.')
+    parser.add_argument('--live', action='store_true', help='Also solve every image both ways.')
+    args = parser.parse_args(argv)
+
+    images = [path for path in find_images(args.directory) if path.lower().endswith(FITS_EXTENSIONS)]
+    if not images:
+        print(f'No FITS images in {args.directory}')
+        return 1
+
+    totals = {'image_bytes': 0, 'list_bytes': 0, 'extract_s': 0.0, 'image_solve_s': 0.0, 'list_solve_s': 0.0}
+    header = f'{"image":<40} {"image bytes":>14} {"list bytes":>12} {"extract s":>10}'
+    if args.live:
+        header += f' {"image solve s":>14} {"list solve s":>13}'
+    print(header)
+
+    for image_path in images:
+        start = time.perf_counter()
+        x, y, width, height = extract_from_file(image_path, n_brightest=args.n_brightest)
+        extract_s = time.perf_counter() - start
+
+        image_bytes = os.path.getsize(image_path)
+        list_bytes = source_list_bytes(x, y, width, height)
+        totals['image_bytes'] += image_bytes
+        totals['list_bytes'] += list_bytes
+        totals['extract_s'] += extract_s
+        line = f'{os.path.basename(image_path):<40} {image_bytes:>14,} {list_bytes:>12,} {extract_s:>10.3f}'
+
+        if args.live:
+            image_solve_s, image_ok = timed_solve(image_path, extract=False)
+            list_solve_s, list_ok = timed_solve(image_path, extract=True)
+            totals['image_solve_s'] += image_solve_s
+            totals['list_solve_s'] += list_solve_s
+            line += f' {image_solve_s:>13.1f}{" " if image_ok else "!"} {list_solve_s:>12.1f}{" " if list_ok else "!"}'
+        print(line)
+
+    print(f'\nTotal bytes sent: {totals["image_bytes"]:,} ( image ) vs {totals["list_bytes"]:,} ( star list ), '
+          f'{totals["image_bytes"] / max(totals["list_bytes"], 1):.0f}x less')
+    print(f'Total extraction time: {totals["extract_s"]:.2f} s')
+    if args.live:
+        print(f'Total solve time: {totals["image_solve_s"]:.1f} s ( image ) vs {totals["list_solve_s"]:.1f} s '
+              '( star list, including extraction )')
+        print('! marks a solve that failed.')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""
+Performance benchmarks for plate solving, pixel coordinates and SIMBAD lookups, run against the local stand-in
+services in mock_services.py so they work offline and give the same numbers from run to run.
+
+Workloads:
+    solve-single       One image solved again and again, like FITSUploader.upload_file().
+    solve-batch        A directory of images solved with batch.py's worker pool.
+    solve-hinted       The same, with the pointing and plate scale in every header used as solve hints.
+    solve-async        The same directory through async_engine.py ( only if aiohttp is installed ).
+    pixcoords-single   One target converted again and again, like find_px_coords().
+    pixcoords-catalog  A large catalog converted in one call.
+    resolve-single     One name looked up again and again, like Finder.find_target().
+    resolve-catalog    A long target list looked up in batched SIMBAD queries.
+    int-extract        uint16 frames ( BZERO = 32768, as cameras write them ) solved from local source lists.
+    int-preprocess     uint16 frames binned before upload, solutions mapped back onto the original grid.
+    int-series         uint16 frames solved as a time series, reusing the reference WCS.
+    int-embed          Solutions written into uint16 frames, both in place and with headers too full for that.
+
+For every workload it reports throughput, p50 / p95 / p99 latency and peak Python memory ( tracemalloc, which
+slows everything a little but the same way every run ). Solves are solve.solve_image() and lookups are
+resolver.resolve(), the code the interactive tools call, without their prompts and printing.
+
+Usage:
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --latency 0.05 --failure-rate 0.02 --solve-time 3 --json results.json
+    python benchmarks/bench_suite.py --workloads solve-batch solve-hinted --solve-time 10 --hinted-solve-time 2
+    python benchmarks/bench_suite.py --workloads pixcoords-catalog resolve-catalog --catalog-size 1000000
+    python benchmarks/bench_suite.py --workloads int-extract int-preprocess int-series int-embed
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_services import PIXEL_SCALE, MockServices, made_up_position, wcs_header  # noqa: E402
+
+WORKLOADS = ('solve-single', 'solve-batch', 'solve-hinted', 'solve-async', 'pixcoords-single', 'pixcoords-catalog',
+             'resolve-single', 'resolve-catalog', 'int-extract', 'int-preprocess', 'int-series', 'int-embed')
+INT_WORKLOADS = ('int-extract', 'int-preprocess', 'int-series', 'int-embed')
+
+
+def percentile(latencies, q):
+    return float(np.percentile(latencies, q)) if latencies else float('nan')
+
+
+def run_workload(name, operations, workers=1):
+    """
+    Runs callables ( on a thread pool when workers > 1 ) and measures them.
+
+    Returns:
+        dict: name, ops, errors, seconds, throughput ( ops / s ), p50, p95 and p99 ( seconds ) and peak_mb.
+    """
+    latencies = []
+    errors = []
+
+    def timed(operation):
+        start = time.perf_counter()
+        try:
+            operation()
+        except Exception as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(timed, operations))
+    else:
+        for operation in operations:
+            timed(operation)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'name': name, 'ops': len(latencies), 'errors': len(errors), 'seconds': seconds,
+            'throughput': len(latencies) / seconds if seconds else float('nan'),
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+            'peak_mb': peak / 2 ** 20, 'first_error': repr(errors[0]) if errors else None}
+
+
+def make_images(directory, count, size, seed=0, pointing=None, integer=False):
+    """
+    Writes count synthetic star fields of size x size pixels and returns their paths. The frames are one field
+    drifting a pixel or two per frame, a minute apart, like a night on one target.
+
+    With pointing ( ra, dec ) every header also gets the RA, DEC, XPIXSZ and FOCALLEN a capture program would
+    write, for the mock plate scale. With integer the frames are uint16, which FITS stores as int16 with
+    BZERO = 32768, like most cameras write them.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    stars = list(zip(rng.uniform(20, size - 20, 100), rng.uniform(20, size - 20, 100), rng.uniform(500, 20000, 100)))
+    start = datetime(2024, 5, 2, 3)
+    paths = []
+    for number in range(count):
+        data = rng.normal(1000, 10, (size, size)).astype(np.float32)
+        for x, y, flux in stars:
+            x, y = x + 2 * (number % 5), y + number % 3
+            box = np.s_[int(y) - 6:int(y) + 7, int(x) - 6:int(x) + 7]
+            data[box] += flux * np.exp(-((xx[box] - x) ** 2 + (yy[box] - y) ** 2) / 4.5)
+        header = fits.Header()
+        header['DATE-OBS'] = (start + timedelta(minutes=number)).isoformat()
+        if pointing is not None:
+            header.update(RA=pointing[0], DEC=pointing[1], XPIXSZ=3.76,
+                          FOCALLEN=206.264806 * 3.76 / (PIXEL_SCALE * 3600))
+        if integer:
+            data = np.clip(data, 0, 65535).astype(np.uint16)
+        prefix = 'int' if integer else 'hinted' if pointing is not None else 'frame'
+        path = os.path.join(directory, f'{prefix}_{number:04d}.fits')
+        fits.writeto(path, data, header, overwrite=True)
+        paths.append(path)
+    return paths
+
+
+def fill_header(path):
+    """ Fills the header blocks of a frame with COMMENT cards, so a merged WCS can't fit in them. """
+    #  Written as uint16 again, so BZERO = 32768 is put back. 36 cards to a block, one of them END.
+    data, header = fits.getdata(path, header=True)
+    while len(header) % 36 != 35:
+        header['COMMENT'] = 'filler'
+        fits.writeto(path, data, header, overwrite=True)
+        header = fits.getheader(path)
+
+
+def embed_checked(path, wcs):
+    """ Embeds a solution and raises if the stored pixel values or BZERO / BSCALE changed. Returns the status. """
+    from embed import embed_wcs
+
+    with fits.open(path, do_not_scale_image_data=True) as hdul:
+        before, header = hdul[0].data.copy(), hdul[0].header
+        scaling = (header.get('BZERO'), header.get('BSCALE'), header['BITPIX'])
+    status = embed_wcs(path, wcs)
+    with fits.open(path, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        if (header.get('BZERO'), header.get('BSCALE'), header['BITPIX']) != scaling:
+            raise AssertionError(f'{path}: scaling changed')
+        if not np.array_equal(hdul[0].data, before):
+            raise AssertionError(f'{path}: pixel values changed')
+    return status
+
+
+def series_checked(paths, **solve_kwargs):
+    """ Solves a time series and raises if a frame failed. Returns how many frames got each method. """
+    from series import solve_series
+
+    methods = [method for _, method in solve_series(paths, **solve_kwargs).values()]
+    if 'failed' in methods:
+        raise AssertionError(f'{methods.count("failed")} frames of the series failed')
+    return {method: methods.count(method) for method in set(methods)}
+
+
+def make_catalog(center_ra, center_dec, count, radius=0.5, seed=0):
+    """ count made up targets around a position, as names, ra and dec lists. """
+    rng = np.random.default_rng(seed)
+    ra = center_ra + rng.uniform(-radius, radius, count) / np.cos(np.radians(center_dec))
+    dec = np.clip(center_dec + rng.uniform(-radius, radius, count), -90, 90)
+    return [f'star {number}' for number in range(count)], list(ra % 360), list(dec)
+
+
+def print_table(results):
+    print(f'\n{"workload":<18} {"ops":>7} {"errors":>6} {"ops/s":>10} {"p50 s":>9} {"p95 s":>9} {"p99 s":>9} '
+          f'{"peak MB":>8}')
+    for result in results:
+        print(f'{result["name"]:<18} {result["ops"]:>7} {result["errors"]:>6} {result["throughput"]:>10.2f} '
+              f'{result["p50"]:>9.4f} {result["p95"]:>9.4f} {result["p99"]:>9.4f} {result["peak_mb"]:>8.1f}')
+    for result in results:
+        if result['first_error']:
+            print(f'{result["name"]}: first error {result["first_error"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark solving, pixel coordinates and SIMBAD lookups offline.')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--images', type=int, default=16, help='Images in the batch workloads ( default: 16 ).')
+    parser.add_argument('--image-size', type=int, default=1024, help='Width and height of the synthetic images.')
+    parser.add_argument('--workers', type=int, default=4, help='Solves in flight in the batch workloads.')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions of the single workloads ( default: 5 ).')
+    parser.add_argument('--catalog-size', type=int, default=100000, help='Targets in pixcoords-catalog.')
+    parser.add_argument('--names', type=int, default=5000, help='Names in resolve-catalog ( default: 5000 ).')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean seconds added to every request.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with 503.')
+    parser.add_argument('--queue-time', type=float, default=0.0, help='Seconds a submission waits for a job.')
+    parser.add_argument('--solve-time', type=float, default=0.0, help='Seconds a job spends solving.')
+    parser.add_argument('--hinted-solve-time', type=float,
+                        help='Seconds a hinted job spends solving ( default: --solve-time ).')
+    parser.add_argument('--solve-timeout', type=int, default=120, help='Seconds to wait on each solve.')
+    parser.add_argument('--json', help='Also write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    server = MockServices(latency=args.latency, failure_rate=args.failure_rate, queue_time=args.queue_time,
+                          solve_time=args.solve_time, hinted_solve_time=args.hinted_solve_time, seed=0).start()
+    workdir = tempfile.TemporaryDirectory(prefix='autoastrometry-bench-')
+
+    #  Every URL and cache location is read from the environment on import, so set them before importing anything.
+    os.environ['ASTROMETRY_NET_URL'] = server.url
+    os.environ['SIMBAD_TAP_URL'] = f'{server.url}/simbad/sim-tap'
+    os.environ['AUTOASTROMETRY_CACHE'] = os.path.join(workdir.name, 'solutions')
+    os.environ['AUTOASTROMETRY_JOURNAL'] = os.path.join(workdir.name, 'journal.sqlite')
+    os.environ['AUTOASTROMETRY_NAME_CACHE'] = os.path.join(workdir.name, 'names.json')
+
+    from batch import solve_and_write
+    from coords import convert_targets
+    from preprocess import Preprocessor
+    from resolver import resolve
+    from solve import solve_image
+
+    images = make_images(workdir.name, max(args.images, 1), args.image_size)
+    wcs_path = os.path.join(workdir.name, 'solved.wcs')
+    center_ra, center_dec = made_up_position('benchmark field')
+    wcs_header(center_ra, center_dec, args.image_size, args.image_size).tofile(wcs_path, overwrite=True)
+    names, ra, dec = make_catalog(center_ra, center_dec, args.catalog_size)
+    hinted_images = []
+    if 'solve-hinted' in args.workloads:
+        hinted_images = make_images(workdir.name, max(args.images, 1), args.image_size,
+                                    pointing=(center_ra, center_dec))
+    int_images = []
+    if set(INT_WORKLOADS) & set(args.workloads):
+        int_images = make_images(workdir.name, max(args.images, 1), args.image_size, integer=True)
+
+    results = []
+    for workload in args.workloads:
+        if workload == 'solve-single':
+            operations = [lambda: solve_image(images[0], solve_timeout=args.solve_timeout)] * args.repeat
+        elif workload == 'solve-batch':
+            operations = [lambda path=path: solve_and_write(path, solve_timeout=args.solve_timeout)
+                          for path in images]
+        elif workload == 'solve-hinted':
+            operations = [lambda path=path: solve_and_write(path, solve_timeout=args.solve_timeout, hints=True)
+                          for path in hinted_images]
+        elif workload == 'solve-async':
+            try:
+                from async_engine import solve_images
+                import aiohttp  # noqa: F401
+            except ImportError:
+                print('Skipping solve-async, aiohttp is not installed.')
+                continue
+            operations = [lambda: solve_images(images, max_uploads=args.workers, deadline=args.solve_timeout)]
+        elif workload == 'pixcoords-single':
+            operations = [lambda: convert_targets(wcs_path, names[:1], ra[:1], dec[:1])] * args.repeat * 200
+        elif workload == 'pixcoords-catalog':
+            operations = [lambda: convert_targets(wcs_path, names, ra, dec)] * args.repeat
+        elif workload == 'resolve-single':
+            operations = [lambda: resolve(['M 13'])] * args.repeat * 4
+        elif workload == 'int-extract':
+            operations = [lambda path=path: solve_and_write(path, solve_timeout=args.solve_timeout, extract=True)
+                          for path in int_images]
+        elif workload == 'int-preprocess':
+            preprocess = Preprocessor(factor=2)
+            operations = [lambda path=path: solve_and_write(path, solve_timeout=args.solve_timeout,
+                                                            preprocess=preprocess) for path in int_images]
+        elif workload == 'int-series':
+            operations = [lambda: print(f'int-series: {series_checked(int_images, solve_timeout=args.solve_timeout)}')]
+        elif workload == 'int-embed':
+            embed_dir = os.path.join(workdir.name, 'embed')
+            os.makedirs(embed_dir, exist_ok=True)
+            embed_images = []
+            for number, path in enumerate(int_images):
+                copy = shutil.copy(path, embed_dir)
+                #  Every other frame has no room left in its header, so it is rewritten instead of updated.
+                if number % 2:
+                    fill_header(copy)
+                embed_images.append(copy)
+            solution = wcs_header(center_ra, center_dec, args.image_size, args.image_size)
+            operations = [lambda path=path: embed_checked(path, solution) for path in embed_images]
+        else:
+            target_names = [f'HD {number}' for number in range(args.names)]
+            operations = [lambda: resolve(target_names)] * args.repeat
+
+        workers = args.workers if workload in ('solve-batch', 'solve-hinted', 'int-extract', 'int-preprocess') else 1
+        result = run_workload(workload, operations, workers)
+        if workload == 'solve-async':
+            #  One call solves the whole batch, so count images rather than calls.
+            result['throughput'] = len(images) / result['seconds']
+        elif workload == 'int-series':
+            result['throughput'] = len(int_images) / result['seconds']
+        results.append(result)
+        print(f'{workload}: {result["ops"]} ops in {result["seconds"]:.2f} s')
+
+    print_table(results)
+    by_name = {result['name']: result for result in results}
+    if 'solve-batch' in by_name and 'solve-hinted' in by_name:
+        blind, hinted = by_name['solve-batch']['p50'], by_name['solve-hinted']['p50']
+        print(f'\nHinted vs blind solve p50: {hinted:.2f} s vs {blind:.2f} s ( {blind / hinted:.1f}x )')
+    print(f'\nMock services: {server.counts}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'mock': server.counts, 'results': results}, f, indent=2)
+
+    server.stop()
+    workdir.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Local stand-in for nova.astrometry.net and the SIMBAD TAP service, so the benchmarks run offline and repeatably.
+
+It answers the parts of both APIs this project uses:
+
+    POST /api/login, /api/upload, /api/url_upload       Log in and submit images or star lists.
+    GET  /api/submissions/<id>, /api/jobs/<id>[/info]   Submission and job status.
+    GET  /wcs_file/<job id>                             WCS header of a solved job.
+    POST /simbad/sim-tap/sync                           SIMBAD name lookups ( query_objects uploads ).
+
+Every request can be slowed down and a share of them can fail with HTTP 503. Submissions wait in a queue and then
+solve for a while before they succeed ( or fail ), and hinted uploads ( with a pointing or plate scale ) can be
+made to solve faster than blind ones. Solutions and SIMBAD positions are made up, but they are the same for the same
+input every time.
+
+Point the code at it with ASTROMETRY_NET_URL=http://host:port and SIMBAD_TAP_URL=http://host:port/simbad/sim-tap.
+
+Usage:
+    python benchmarks/mock_services.py --port 8080 --latency 0.05 --failure-rate 0.01 --solve-time 5
+"""
+
+import argparse
+import email.parser
+import hashlib
+import io
+import itertools
+import json
+import random
+import struct
+import threading
+import time
+import urllib.parse
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from astropy.io import fits, votable
+from astropy.table import MaskedColumn, Table
+from astropy.wcs import WCS
+
+# * Image size assumed when an upload isn't a FITS file, and the plate scale of every made up solution.
+DEFAULT_IMAGE_SIZE = 1024
+PIXEL_SCALE = 1.0 / 3600
+
+
+def name_seed(text):
+    """ Stable 64 bit number for a string. """
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+
+def made_up_position(text):
+    """ RA / Dec in degrees that always comes out the same for the same text. """
+    rng = np.random.default_rng(name_seed(text))
+    return float(rng.uniform(0, 360)), float(np.degrees(np.arcsin(rng.uniform(-1, 1))))
+
+
+def wcs_header(ra, dec, width, height, scale=PIXEL_SCALE):
+    """ TAN WCS header like the ones nova.astrometry.net hands out, centred on ra / dec. """
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(width + 1) / 2, (height + 1) / 2]
+    wcs.wcs.cd = [[-scale, 0], [0, scale]]
+    header = fits.Header({'SIMPLE': True, 'BITPIX': 8, 'NAXIS': 0})
+    header.update(wcs.to_header())
+    header['IMAGEW'] = width
+    header['IMAGEH'] = height
+    return header
+
+
+def multipart_fields(content_type, body):
+    """ Parts of a multipart/form-data body as name -> bytes. """
+    message = email.parser.BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+            for part in message.get_payload()}
+
+
+def image_size(data):
+    """ Width and height of an uploaded FITS or PNG image. """
+    if data.startswith(b'\x89PNG'):
+        return struct.unpack('>II', data[16:24])
+    try:
+        header = fits.Header.fromstring(data[:data.index(b'END' + b' ' * 77) + 80])
+        return int(header['NAXIS1']), int(header['NAXIS2'])
+    except (ValueError, KeyError):
+        return DEFAULT_IMAGE_SIZE, DEFAULT_IMAGE_SIZE
+
+
+class MockServices(ThreadingHTTPServer):
+    """
+    HTTP server playing nova.astrometry.net and SIMBAD.
+
+    Args:
+        address (tuple): ( host, port ), port 0 picks a free one.
+        latency (float, optional): Mean seconds added to every request ( uniformly 0.5 - 1.5 times this ).
+        failure_rate (float, optional): Share of requests ( other than login ) answered with HTTP 503.
+        queue_time (float, optional): Seconds a submission waits before it gets a job.
+        solve_time (float, optional): Seconds a job spends solving.
+        hinted_solve_time (float, optional): Seconds a job uploaded with a pointing or scale hint spends solving,
+            defaults to solve_time.
+        solve_failure_rate (float, optional): Share of jobs that end in failure.
+        unknown_rate (float, optional): Share of target names SIMBAD doesn't know.
+        seed (int, optional): Seed for the random delays and failures.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, failure_rate=0.0, queue_time=0.0, solve_time=0.0,
+                 hinted_solve_time=None, solve_failure_rate=0.0, unknown_rate=0.0, seed=None):
+        super().__init__(address, MockHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.queue_time = queue_time
+        self.solve_time = solve_time
+        self.hinted_solve_time = solve_time if hinted_solve_time is None else hinted_solve_time
+        self.solve_failure_rate = solve_failure_rate
+        self.unknown_rate = unknown_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.submissions = {}
+        self.jobs = {}
+        self.counts = {'requests': 0, 'failed': 0, 'uploaded_bytes': 0, 'submissions': 0, 'hinted': 0,
+                       'simbad_names': 0}
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """ Serves from a background thread. """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def submit(self, width, height, settings=None):
+        """ Starts a made up solve and returns its submission ID. """
+        hinted = any(key in (settings or {}) for key in ('center_ra', 'scale_lower'))
+        with self.lock:
+            submission_id = next(self.ids)
+            self.submissions[submission_id] = {'created': time.monotonic(), 'width': width, 'height': height,
+                                               'hinted': hinted, 'job': None}
+        self.count('submissions')
+        if hinted:
+            self.count('hinted')
+        return submission_id
+
+    def submission_jobs(self, submission_id):
+        with self.lock:
+            submission = self.submissions[submission_id]
+            if submission['job'] is None and time.monotonic() - submission['created'] >= self.queue_time:
+                job_id = next(self.ids)
+                submission['job'] = job_id
+                self.jobs[job_id] = {'started': time.monotonic(), 'submission': submission_id,
+                                     'fails': self.random.random() < self.solve_failure_rate,
+                                     'solve_time': self.hinted_solve_time if submission['hinted'] else self.solve_time}
+            return [submission['job']] if submission['job'] else []
+
+    def job_status(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+        if time.monotonic() - job['started'] < job['solve_time']:
+            return 'solving'
+        return 'failure' if job['fails'] else 'success'
+
+    def job_wcs(self, job_id):
+        with self.lock:
+            submission = self.submissions[self.jobs[job_id]['submission']]
+        ra, dec = made_up_position(f'submission {self.jobs[job_id]["submission"]}')
+        return wcs_header(ra, dec, submission['width'], submission['height'])
+
+    def simbad_table(self, names, numbers):
+        """ VOTable answer to a query_objects upload. """
+        self.count('simbad_names', len(names))
+        known = [self.draw() >= self.unknown_rate for _ in names]
+        positions = [made_up_position(name.lower()) for name in names]
+        table = Table()
+        table['main_id'] = [name.upper() if ok else '' for name, ok in zip(names, known)]
+        table['ra'] = MaskedColumn([ra for ra, _ in positions], mask=[not ok for ok in known], unit='deg')
+        table['dec'] = MaskedColumn([dec for _, dec in positions], mask=[not ok for ok in known], unit='deg')
+        table['user_specified_id'] = names
+        table['object_number_id'] = numbers
+        f = io.BytesIO()
+        votable.from_table(table).to_xml(f)
+        return f.getvalue()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type='application/json', status=200):
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay_or_fail(self):
+        """ Applies the configured latency, and returns True if this request should fail. """
+        server = self.server
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.draw()))
+        if server.failure_rate and not self.path.endswith('/login') and server.draw() < server.failure_rate:
+            server.count('failed')
+            self.send('Service unavailable', 'text/plain', status=503)
+            return True
+        return False
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count('uploaded_bytes', len(body))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            return multipart_fields(content_type, body)
+        return {name: values[0].encode() for name, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    def do_POST(self):
+        if self.delay_or_fail():
+            return
+        fields = self.read_body()
+        path = urllib.parse.urlparse(self.path).path.rstrip('/')
+
+        if path == '/api/login':
+            return self.send({'status': 'success', 'session': 'mock-session'})
+        if path == '/api/upload':
+            width, height = image_size(fields.get('file', b''))
+            settings = json.loads(fields.get('request-json', b'{}'))
+            return self.send({'status': 'success', 'subid': self.server.submit(width, height, settings)})
+        if path == '/api/url_upload':
+            settings = json.loads(fields['request-json'])
+            submission_id = self.server.submit(int(settings['image_width']), int(settings['image_height']),
+                                               settings)
+            return self.send({'status': 'success', 'subid': submission_id})
+        if path == '/simbad/sim-tap/sync':
+            upload = next(value for name, value in fields.items() if name not in ('REQUEST', 'LANG', 'QUERY',
+                                                                                    'UPLOAD', 'FORMAT', 'MAXREC'))
+            names = votable.parse_single_table(io.BytesIO(upload)).to_table()
+            return self.send(self.server.simbad_table([str(name) for name in names['user_specified_id']],
+                                                      [int(number) for number in names['object_number_id']]),
+                             'application/x-votable+xml')
+        self.send({'status': 'error', 'errormessage': f'unknown endpoint {path}'}, status=404)
+
+    def do_GET(self):
+        if self.delay_or_fail():
+            return
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        try:
+            if parts[:2] == ['api', 'submissions']:
+                return self.send({'jobs': self.server.submission_jobs(int(parts[2]))})
+            if parts[:2] == ['api', 'jobs']:
+                return self.send({'status': self.server.job_status(int(parts[2]))})
+            if parts[0] == 'wcs_file':
+                return self.send(self.server.job_wcs(int(parts[1])).tostring(), 'application/fits')
+        except (KeyError, IndexError, ValueError):
+            pass
+        self.send({'status': 'error', 'errormessage': 'not found'}, status=404)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local stand-in for nova.astrometry.net and SIMBAD.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean seconds added to every request.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with 503.')
+    parser.add_argument('--queue-time', type=float, default=0.0, help='Seconds a submission waits for a job.')
+    parser.add_argument('--solve-time', type=float, default=0.0, help='Seconds a job spends solving.')
+    parser.add_argument('--hinted-solve-time', type=float,
+                        help='Seconds a job with a pointing or scale hint spends solving ( default: --solve-time ).')
+    parser.add_argument('--solve-failure-rate', type=float, default=0.0, help='Share of jobs that fail.')
+    parser.add_argument('--unknown-rate', type=float, default=0.0, help="Share of names SIMBAD doesn't know.")
+    args = parser.parse_args(argv)
+
+    server = MockServices((args.host, args.port), latency=args.latency, failure_rate=args.failure_rate,
+                          queue_time=args.queue_time, solve_time=args.solve_time,
+                          hinted_solve_time=args.hinted_solve_time, solve_failure_rate=args.solve_failure_rate,
+                          unknown_rate=args.unknown_rate)
+    print(f'ASTROMETRY_NET_URL={server.url}')
+    print(f'SIMBAD_TAP_URL={server.url}/simbad/sim-tap')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,196 @@
+"""
+On-disk cache of plate solutions. Entries are keyed by a hash of the image pixel data, not the file name, so the
+same frame is never sent to nova.astrometry.net twice even if it has been renamed or copied.
+
+Usage:
+    python cache.py --invalidate /path/to/frame.fits
+    python cache.py --clear
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import numpy as np
+from astropy.io import fits
+import metrics
+
+# * Default cache location and size limit.
+CACHE_DIR = os.environ.get('AUTOASTROMETRY_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'autoastrometry', 'solutions'))
+MAX_BYTES = 256 * 1024 * 1024
+
+# * Bytes read at a time when hashing non FITS images.
+CHUNK_SIZE = 1024 * 1024
+
+
+def image_hash(image_path):
+    """
+    Hashes the pixel data of an image.
+
+    FITS files are hashed on the data of every HDU ( with its shape and data type ), so changing only the header
+    keeps the same key. Anything else ( PNG, JPEG ) is hashed on the raw file bytes.
+
+    Args:
+        image_path (str): Path to the image.
+
+    Returns:
+        str: Hex digest of the pixel data.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+
+    with metrics.stage('hash', image=image_path):
+        if image_path.lower().endswith(('.fits', '.fit', '.fts')):
+            #  Raw ( unscaled ) data straight from the memory map, so nothing is copied or converted.
+            with fits.open(image_path, memmap=True, do_not_scale_image_data=True) as hdul:
+                for hdu in hdul:
+                    if hdu.data is None:
+                        continue
+                    data = np.ascontiguousarray(hdu.data)
+                    digest.update(f'{data.dtype.str}{data.shape}'.encode())
+                    digest.update(data)
+        else:
+            with open(image_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class SolutionCache():
+    """
+    Size bounded, least recently used cache of WCS headers.
+
+    Every entry is a single header file named after its image hash. The modification time of the file is used as
+    the last used time, so the cache needs no separate index and survives being shared between processes.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.wcs')
+
+    def get(self, key):
+        """
+        Looks up a solution.
+
+        Args:
+            key (str): Image hash from image_hash().
+
+        Returns:
+            astropy.io.fits.Header: The cached WCS header, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            header = fits.Header.fromfile(path)
+        except (FileNotFoundError, OSError):
+            return None
+
+        # * Marks the entry as recently used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return header
+
+    def put(self, key, wcs_header):
+        """
+        Stores a solution then evicts the least recently used entries if the cache is over its size limit.
+
+        Args:
+            key (str): Image hash from image_hash().
+            wcs_header (astropy.io.fits.Header): Solved WCS header.
+        """
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        #  Writes to a temporary file first so a reader never sees half a header.
+        wcs_header.tofile(tmp_path, overwrite=True)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def invalidate(self, key):
+        """
+        Removes a single entry.
+
+        Returns:
+            bool: True if there was an entry to remove.
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def invalidate_image(self, image_path):
+        """ Removes the entry for an image, found by hashing its pixel data. """
+        return self.invalidate(image_hash(image_path))
+
+    def clear(self):
+        """
+        Removes every entry.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        removed = 0
+        for key, _, _ in self._entries():
+            if self.invalidate(key):
+                removed += 1
+        return removed
+
+    def _entries(self):
+        """ Every entry as ( key, last used time, size in bytes ). """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.wcs'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((file_name[:-len('.wcs')], stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits in max_bytes. """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            total = sum(size for _, _, size in entries)
+            for key, _, size in entries:
+                if total <= self.max_bytes:
+                    break
+                self.invalidate(key)
+                total -= size
+
+    def __len__(self):
+        return len(self._entries())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the local plate solution cache.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'Cache directory ( default: {CACHE_DIR} ).')
+    parser.add_argument('--invalidate', nargs='+', metavar='IMAGE', default=[],
+                        help='Remove the cached solutions of these images.')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached solution.')
+    args = parser.parse_args(argv)
+
+    cache = SolutionCache(args.cache_dir)
+    for image_path in args.invalidate:
+        if cache.invalidate_image(image_path):
+            print(f'Removed {image_path}')
+        else:
+            print(f'Not cached {image_path}')
+    if args.clear:
+        print(f'Removed {cache.clear()} cached solutions.')
+    print(f'{len(cache)} cached solutions in {cache.cache_dir}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,382 @@
+"""
+Local star catalog for picking comparison stars without a network connection.
+
+A downloaded catalog ( APASS, UCAC4, Gaia, ... as CSV, FITS or VOTable ) is built once into an index of memory-mapped
+NumPy arrays, with the stars sorted into declination zones and by RA within each zone. A query for a plate solved
+image only touches the zones its footprint crosses and returns the stars in a magnitude range, already projected to
+pixel coordinates.
+
+The index lives in AUTOASTROMETRY_CATALOG ( default ~/.cache/autoastrometry/catalog ). RA and Dec in the catalog can
+be degrees or sexagesimal, see coords.to_skycoord().
+
+Usage:
+    python catalog.py build apass.csv --mag-column Vmag --name-column recno
+    python catalog.py query new-image.fits --mag 10 14
+    python catalog.py comps new-image.fits --mag 10 14 --count 8 --target "19:07:14 +04:43:12"
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+from astropy.table import Table
+import metrics
+from coords import load_wcs, to_skycoord
+
+# * Default index location.
+CATALOG_DIR = os.environ.get('AUTOASTROMETRY_CATALOG',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'autoastrometry', 'catalog'))
+
+# * Height of a declination zone in degrees. Smaller zones read less for small fields, but there are more of them.
+ZONE_HEIGHT = 0.25
+
+# * Comparison star picking: how many, how far ( pixels ) from the image edge and from any neighbour that is less
+# * than ISOLATION_MAG fainter, so the neighbour can't leak into the aperture.
+COMP_STAR_COUNT = 10
+EDGE_PIXELS = 20
+ISOLATION_PIXELS = 15
+ISOLATION_MAG = 3.0
+
+# * Output columns.
+COLUMNS = ('name', 'ra', 'dec', 'mag', 'x', 'y')
+
+# * Arrays that make up an index, next to meta.json.
+ARRAYS = ('ra', 'dec', 'mag', 'name', 'zones')
+
+
+def _column(table, name):
+    """ Column of a table, ignoring case. """
+    for column in table.colnames:
+        if column.lower() == name.lower():
+            return table[column]
+    raise ValueError(f'The catalog has no {name} column, it has {", ".join(table.colnames)}')
+
+
+def _filled(column, dtype):
+    if hasattr(column, 'filled'):
+        column = column.filled(np.nan if np.dtype(dtype).kind == 'f' else '')
+    return np.asarray(column, dtype=dtype)
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    """ Angle between positions in degrees ( haversine, fine at any distance ). """
+    ra1, dec1, ra2, dec2 = (np.radians(value) for value in (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+def _save(directory, name, array):
+    #  Written next to the old file and swapped in, so a rebuild never leaves a half written array behind.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(directory, f'{name}.npy'))
+
+
+def build_index(catalog_path, directory=CATALOG_DIR, ra_column='ra', dec_column='dec', mag_column='mag',
+                name_column=None, zone_height=ZONE_HEIGHT):
+    """
+    Builds the index from a catalog file.
+
+    Args:
+        catalog_path (str): CSV, FITS or VOTable catalog.
+        directory (str, optional): Where to write the index. An index already there is replaced.
+        ra_column, dec_column, mag_column (str, optional): Column names, case doesn't matter.
+        name_column (str, optional): Column with star names or IDs. Stars are named by row number without it.
+        zone_height (float, optional): Declination zone height in degrees.
+
+    Returns:
+        int: Number of stars in the index.
+    """
+    table = Table.read(catalog_path, format='ascii.csv' if catalog_path.lower().endswith('.csv') else None)
+
+    ra, dec = _column(table, ra_column), _column(table, dec_column)
+    if ra.dtype.kind in 'fiu' and dec.dtype.kind in 'fiu':
+        ra, dec = _filled(ra, np.float64), _filled(dec, np.float64)
+    else:
+        coords = to_skycoord([str(value) for value in ra], [str(value) for value in dec])
+        ra, dec = coords.ra.deg, coords.dec.deg
+    mag = _filled(_column(table, mag_column), np.float32)
+    if name_column:
+        names = _filled(_column(table, name_column), str)
+    else:
+        names = np.arange(1, len(table) + 1).astype(str)
+
+    # * Stars without a position can never be in a field.
+    keep = np.isfinite(ra) & np.isfinite(dec)
+    ra, dec, mag, names = ra[keep] % 360, dec[keep], mag[keep], names[keep]
+
+    zone_count = int(np.ceil(180 / zone_height))
+    zone = np.clip(((dec + 90) / zone_height).astype(np.int64), 0, zone_count - 1)
+    order = np.lexsort((ra, zone))
+    #  zones[z]:zones[z + 1] are the rows of zone z.
+    zones = np.searchsorted(zone[order], np.arange(zone_count + 1))
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in (('ra', ra[order]), ('dec', dec[order]), ('mag', mag[order]),
+                        ('name', np.char.encode(names[order], 'utf-8')), ('zones', zones)):
+        _save(directory, name, array)
+
+    #  meta.json goes last, an index without it is unfinished and won't be opened.
+    meta = {'stars': int(len(ra)), 'zone_height': zone_height, 'source': os.path.abspath(catalog_path),
+            'mag_column': mag_column}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return len(ra)
+
+
+def has_index(directory=CATALOG_DIR):
+    """ True if an index has been built in directory. """
+    return os.path.exists(os.path.join(directory, 'meta.json'))
+
+
+class StarCatalog():
+    """
+    Memory-mapped catalog index. Opening it reads only the metadata, queries read only the zones they need.
+
+    Args:
+        directory (str, optional): Directory written by build_index().
+    """
+
+    def __init__(self, directory=CATALOG_DIR):
+        if not has_index(directory):
+            raise FileNotFoundError(f'No star catalog in {directory}, build one with python catalog.py build')
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.zone_height = self.meta['zone_height']
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.ra)
+
+    def cone(self, ra, dec, radius):
+        """
+        Rows of every star within the RA / Dec box around a cone ( all in degrees ).
+
+        Returns:
+            numpy.ndarray: Row numbers, a few stars outside the cone but inside its box are included.
+        """
+        dec_low, dec_high = dec - radius, dec + radius
+        ratio = np.sin(np.radians(radius)) / np.cos(np.radians(dec)) if abs(dec) < 90 else 1
+        if dec_low <= -90 or dec_high >= 90 or ratio >= 1:
+            # * The cone covers a pole, so every RA.
+            windows = [(0, 360)]
+        else:
+            #  Widest RA extent of a cone, reached north or south of its centre.
+            half_width = np.degrees(np.arcsin(ratio))
+            low, high = (ra - half_width) % 360, (ra + half_width) % 360
+            windows = [(low, high)] if low <= high else [(low, 360), (0, high)]
+
+        first, last = (int(np.clip((value + 90) / self.zone_height, 0, len(self.zones) - 2))
+                       for value in (dec_low, dec_high))
+        rows = []
+        for zone in range(first, last + 1):
+            start, end = int(self.zones[zone]), int(self.zones[zone + 1])
+            zone_ra = self.ra[start:end]
+            for low, high in windows:
+                rows.append(np.arange(start + np.searchsorted(zone_ra, low, 'left'),
+                                      start + np.searchsorted(zone_ra, high, 'right')))
+        return np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+
+    def query(self, wcs, shape, mag_range=None, edge=0):
+        """
+        Every star on an image.
+
+        Args:
+            wcs (astropy.wcs.WCS): WCS of the plate solved image.
+            shape (tuple): ( height, width ) of the image.
+            mag_range (tuple, optional): ( brightest, faintest ) magnitude, either can be None.
+            edge (float, optional): Leave out stars closer than this many pixels to the image edge.
+
+        Returns:
+            dict: Arrays for every key in COLUMNS. Pixel coordinates are 0 indexed, like coords.pixel_coords().
+        """
+        height, width = shape
+        with metrics.stage('catalog_query') as fields:
+            # * Footprint as a cone around the image centre that reaches the corners and edge midpoints.
+            x = np.array([(width - 1) / 2, -0.5, width - 0.5, -0.5, width - 0.5, (width - 1) / 2, (width - 1) / 2,
+                          -0.5, width - 0.5])
+            y = np.array([(height - 1) / 2, -0.5, -0.5, height - 0.5, height - 0.5, -0.5, height - 0.5,
+                          (height - 1) / 2, (height - 1) / 2])
+            ra, dec = wcs.pixel_to_world_values(x, y)
+            radius = float(np.max(_separation(ra[0], dec[0], ra[1:], dec[1:])))
+            rows = np.sort(self.cone(float(ra[0]) % 360, float(dec[0]), radius))
+
+            mag = np.asarray(self.mag[rows])
+            if mag_range is not None:
+                brightest, faintest = mag_range
+                keep = np.ones(len(rows), dtype=bool)
+                if brightest is not None:
+                    keep &= mag >= brightest
+                if faintest is not None:
+                    keep &= mag <= faintest
+                rows, mag = rows[keep], mag[keep]
+
+            ra, dec = np.asarray(self.ra[rows]), np.asarray(self.dec[rows])
+            x, y = (np.atleast_1d(value) for value in wcs.world_to_pixel_values(ra, dec))
+            on_image = (np.isfinite(x) & np.isfinite(y) & (x >= edge - 0.5) & (x < width - 0.5 - edge)
+                        & (y >= edge - 0.5) & (y < height - 0.5 - edge))
+            fields.update(searched=len(rows), found=int(on_image.sum()))
+
+        names = np.char.decode(np.asarray(self.name[rows[on_image]]), 'utf-8')
+        return {'name': names, 'ra': ra[on_image], 'dec': dec[on_image], 'mag': mag[on_image],
+                'x': x[on_image], 'y': y[on_image]}
+
+
+def rows_from(stars, order=None):
+    """ Query arrays as a list of dicts with the keys in COLUMNS, magnitudes rounded to millimag. """
+    order = np.arange(len(stars['ra'])) if order is None else order
+    return [{'name': str(stars['name'][i]), 'ra': float(stars['ra'][i]), 'dec': float(stars['dec'][i]),
+             'mag': round(float(stars['mag'][i]), 3), 'x': float(stars['x'][i]), 'y': float(stars['y'][i])}
+            for i in order]
+
+
+def stars_on_image(solved_image, mag_range=None, catalog=None):
+    """
+    Every catalog star on a plate solved image.
+
+    Args:
+        solved_image (str): Plate solved image ( new-image.fits ) or .wcs header.
+        mag_range (tuple, optional): ( brightest, faintest ) magnitude.
+        catalog (StarCatalog, optional): Defaults to the index in CATALOG_DIR.
+
+    Returns:
+        list: One dict per star with the keys in COLUMNS, brightest first.
+    """
+    catalog = catalog or StarCatalog()
+    wcs, shape = _solved(solved_image)
+    stars = catalog.query(wcs, shape, mag_range)
+    return rows_from(stars, np.argsort(stars['mag'], kind='stable'))
+
+
+def comparison_stars(solved_image, mag_range=None, count=COMP_STAR_COUNT, target=None, catalog=None,
+                     edge=EDGE_PIXELS, isolation=ISOLATION_PIXELS):
+    """
+    Picks comparison stars for a plate solved image.
+
+    Stars in the magnitude range are kept if they are away from the image edge and have no neighbour within
+    isolation pixels that is less than ISOLATION_MAG fainter. The target itself is never picked.
+
+    Args:
+        solved_image (str): Plate solved image ( new-image.fits ) or .wcs header.
+        mag_range (tuple, optional): ( brightest, faintest ) magnitude.
+        count (int, optional): Most stars to return.
+        target (astropy.coordinates.SkyCoord, optional): Target position. Stars closest to it are picked first,
+            otherwise the brightest.
+        catalog (StarCatalog, optional): Defaults to the index in CATALOG_DIR.
+        edge (float, optional): Pixels to keep away from the image edge.
+        isolation (float, optional): Pixels to the nearest neighbour that could leak into the aperture.
+
+    Returns:
+        list: One dict per star with the keys in COLUMNS.
+    """
+    catalog = catalog or StarCatalog()
+    wcs, shape = _solved(solved_image)
+    #  Every star on the image, faint ones included, can spoil a comparison star.
+    stars = catalog.query(wcs, shape)
+    brightest, faintest = mag_range or (None, None)
+    candidates = np.flatnonzero(
+        (stars['x'] >= edge - 0.5) & (stars['x'] < shape[1] - 0.5 - edge) & (stars['y'] >= edge - 0.5)
+        & (stars['y'] < shape[0] - 0.5 - edge)
+        & (stars['mag'] >= (-np.inf if brightest is None else brightest))
+        & (stars['mag'] <= (np.inf if faintest is None else faintest)))
+
+    target_x = target_y = None
+    if target is not None:
+        target_x, target_y = (float(value) for value in wcs.world_to_pixel(target))
+
+    # * Neighbour search along x only looks at the stars in a narrow sorted strip.
+    by_x = np.argsort(stars['x'], kind='stable')
+    sorted_x = stars['x'][by_x]
+    isolated = []
+    for i in candidates:
+        x, y, mag = stars['x'][i], stars['y'][i], stars['mag'][i]
+        if target_x is not None and np.hypot(x - target_x, y - target_y) < isolation:
+            continue
+        strip = by_x[np.searchsorted(sorted_x, x - isolation):np.searchsorted(sorted_x, x + isolation, 'right')]
+        strip = strip[strip != i]
+        close = np.hypot(stars['x'][strip] - x, stars['y'][strip] - y) < isolation
+        #  A NaN magnitude is unknown, so it counts as bright enough to matter.
+        if np.any(close & ~(stars['mag'][strip] > mag + ISOLATION_MAG)):
+            continue
+        isolated.append(i)
+
+    isolated = np.array(isolated, dtype=np.int64)
+    if target_x is not None:
+        key = np.hypot(stars['x'][isolated] - target_x, stars['y'][isolated] - target_y)
+    else:
+        key = stars['mag'][isolated]
+    return rows_from(stars, isolated[np.argsort(key, kind='stable')][:count])
+
+
+def _solved(solved_image):
+    wcs, shape = load_wcs(solved_image)
+    if shape is None:
+        raise ValueError(f"{solved_image} doesn't say how big the image is.")
+    return wcs, shape
+
+
+def write_rows(rows, f):
+    """ Writes catalog stars as CSV. """
+    writer = csv.DictWriter(f, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and query a local star catalog.')
+    parser.add_argument('--catalog-dir', default=CATALOG_DIR, help=f'Index directory ( default: {CATALOG_DIR} ).')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='Build the index from a catalog file.')
+    build.add_argument('catalog', help='CSV, FITS or VOTable catalog.')
+    build.add_argument('--ra-column', default='ra')
+    build.add_argument('--dec-column', default='dec')
+    build.add_argument('--mag-column', default='mag')
+    build.add_argument('--name-column')
+    build.add_argument('--zone-height', type=float, default=ZONE_HEIGHT,
+                       help=f'Declination zone height in degrees ( default: {ZONE_HEIGHT} ).')
+
+    for name, help_text in (('query', 'List every catalog star on a plate solved image.'),
+                            ('comps', 'Pick comparison stars on a plate solved image.')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('solved_image', help='Plate solved image ( new-image.fits ) or .wcs header.')
+        command.add_argument('--mag', nargs=2, type=float, metavar=('BRIGHTEST', 'FAINTEST'),
+                             help='Magnitude range.')
+        command.add_argument('-o', '--output', help='Write the CSV here instead of printing it.')
+        if name == 'comps':
+            command.add_argument('--count', type=int, default=COMP_STAR_COUNT,
+                                 help=f'Comparison stars to pick ( default: {COMP_STAR_COUNT} ).')
+            command.add_argument('--target', help='Target RA and Dec, comparison stars near it are picked first.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        stars = build_index(args.catalog, args.catalog_dir, args.ra_column, args.dec_column, args.mag_column,
+                            args.name_column, args.zone_height)
+        print(f'Indexed {stars} stars in {args.catalog_dir}')
+        return 0
+
+    catalog = StarCatalog(args.catalog_dir)
+    if args.command == 'query':
+        rows = stars_on_image(args.solved_image, args.mag, catalog)
+    else:
+        target = None
+        if args.target:
+            ra, dec = args.target.rsplit(' ', 1) if ' ' in args.target else args.target.split(',')
+            target = to_skycoord([ra], [dec])[0]
+        rows = comparison_stars(args.solved_image, args.mag, args.count, target, catalog)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_rows(rows, f)
+    else:
+        write_rows(rows, sys.stdout)
+    return 0 if rows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Headless command line for cron jobs and reduction workers. Everything comes from arguments and files, results are
+printed as JSON ( default ) or CSV, and the exit code says how it went.
+
+Usage:
+    python cli.py solve /path/to/night frame.fits --workers 8
+    python cli.py resolve M13 Vega --file targets.txt --format csv
+    python cli.py pixcoords new-image.fits stars.csv
+    python cli.py comps new-image.fits --mag 10 14 --count 8
+    python cli.py embed /path/to/night --workers 16
+
+Exit codes:
+    0  Everything worked.
+    1  Ran, but some images could not be solved or some names could not be found.
+    2  Bad arguments.
+    3  Could not run at all ( missing file, network down, ... ).
+"""
+
+import argparse
+import csv
+import json
+import sys
+import api
+import metrics
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_ERROR = 3
+
+
+def write_output(rows, output_format, f=sys.stdout):
+    """ Writes a list of dicts as JSON or CSV. """
+    if output_format == 'json':
+        json.dump(rows, f, indent=2)
+        f.write('\n')
+        return
+    if not rows:
+        return
+    writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def run_solve(args):
+    rows = api.solve(args.paths, workers=args.workers, solver=args.solver, extract=args.extract,
+                     use_cache=not args.no_cache, solve_timeout=args.timeout, solve_field=args.solve_field,
+                     config=args.config, engine=args.engine, max_upload_mb=args.max_upload_mb,
+                     bin_factor=args.bin, crop=args.crop, upload_format=args.upload_format, hints=args.hints,
+                     embed=args.embed)
+    return rows, all(row['solved'] for row in rows)
+
+
+def run_resolve(args):
+    names = list(args.names)
+    if args.file:
+        with open(args.file) as f:
+            names += [line.strip() for line in f if line.strip()]
+    if not names:
+        #  Exits with EXIT_USAGE, like any other bad argument.
+        args.error('give some target names or --file')
+    rows = api.resolve(names, use_cache=not args.no_cache)
+    return rows, all(row['ra'] is not None for row in rows)
+
+
+def run_pixcoords(args):
+    rows = api.pixcoords(args.solved_image, args.targets)
+    return rows, True
+
+
+def run_comps(args):
+    rows = api.comps(args.solved_image, args.mag, args.count, args.target)
+    return rows, bool(rows)
+
+
+def run_embed(args):
+    rows = api.embed(args.paths, workers=args.workers, from_cache=args.from_cache)
+    return rows, all(row['status'] not in (None, 'no_solution') for row in rows)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Plate solve images, resolve targets and find pixel coordinates.')
+    parser.add_argument('--format', choices=('json', 'csv'), default='json', help='Output format ( default: json ).')
+    parser.add_argument('--trace', help='Append a JSON line with the timing of every stage to this file.')
+    parser.add_argument('--metrics', help='Write Prometheus metrics to this file when done.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    solve = commands.add_parser('solve', help='Plate solve images and write their WCS headers next to them.')
+    solve.add_argument('paths', nargs='+', help='Image files and / or directories of images.')
+    solve.add_argument('--workers', type=int, default=4, help='Solves kept in flight at once ( default: 4 ).')
+    solve.add_argument('--solver', choices=('astrometry.net', 'local'), default='astrometry.net',
+                       help='Solve on nova.astrometry.net or with a local solve-field ( default: astrometry.net ).')
+    solve.add_argument('--engine', choices=('threads', 'async'), default='threads',
+                       help='Thread per solve, or every job from one asyncio event loop ( default: threads ).')
+    solve.add_argument('--extract', action='store_true',
+                       help='Find stars locally and upload only their positions instead of whole images.')
+    solve.add_argument('--no-cache', action='store_true', help='Ignore the solution cache and submission journal.')
+    solve.add_argument('--timeout', type=int, help='Seconds to wait on each solve.')
+    solve.add_argument('--solve-field', default='solve-field', help='solve-field executable for --solver local.')
+    solve.add_argument('--config', help='astrometry.cfg listing the index files for --solver local.')
+    solve.add_argument('--hints', action='store_true',
+                       help='Narrow each solve to the pointing and plate scale in the FITS header.')
+    solve.add_argument('--embed', action='store_true',
+                       help='Also write each solution into the header of the original FITS file.')
+    solve.add_argument('--max-upload-mb', type=float,
+                       help='Bin ( and if needed crop ) FITS images until each upload is under this many MiB.')
+    solve.add_argument('--bin', type=int, help='Bin FITS images by this factor before uploading.')
+    solve.add_argument('--crop', type=float, help='Upload only this central fraction of the width and height.')
+    solve.add_argument('--upload-format', choices=('png', 'fits'), default='png',
+                       help='Format of shrunk uploads, 8 bit PNG or Rice compressed FITS ( default: png ).')
+    solve.set_defaults(run=run_solve)
+
+    resolve = commands.add_parser('resolve', help='Look up the RA and Dec of target names in SIMBAD.')
+    resolve.add_argument('names', nargs='*', help='Target names.')
+    resolve.add_argument('--file', help='Text file with one target name per line.')
+    resolve.add_argument('--no-cache', action='store_true', help='Always ask SIMBAD, ignoring cached answers.')
+    resolve.set_defaults(run=run_resolve, error=resolve.error)
+
+    pixcoords = commands.add_parser('pixcoords', help='Convert RA / Dec values to pixel coordinates.')
+    pixcoords.add_argument('solved_image', help='Plate solved image ( new-image.fits ) or .wcs header.')
+    pixcoords.add_argument('targets', help='CSV with ra and dec columns ( and optionally name ).')
+    pixcoords.set_defaults(run=run_pixcoords)
+
+    comps = commands.add_parser('comps', help='Pick comparison stars from the local star catalog.')
+    comps.add_argument('solved_image', help='Plate solved image ( new-image.fits ) or .wcs header.')
+    comps.add_argument('--mag', nargs=2, type=float, metavar=('BRIGHTEST', 'FAINTEST'), help='Magnitude range.')
+    comps.add_argument('--count', type=int, default=10, help='Comparison stars to pick ( default: 10 ).')
+    comps.add_argument('--target', nargs=2, metavar=('RA', 'DEC'),
+                       help='Target position, comparison stars near it are picked first.')
+    comps.set_defaults(run=run_comps)
+
+    embed = commands.add_parser('embed', help='Write solutions into the headers of the original FITS files.')
+    embed.add_argument('paths', nargs='+', help='FITS files and / or directories of them.')
+    embed.add_argument('--workers', type=int, default=8, help='Files worked on at once ( default: 8 ).')
+    embed.add_argument('--from-cache', action='store_true',
+                       help='Look in the solution cache for images without a .wcs next to them.')
+    embed.set_defaults(run=run_embed)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    metrics.configure(trace_path=args.trace, metrics_path=args.metrics)
+    try:
+        rows, complete = args.run(args)
+    except Exception as e:
+        print(f'error: {e}', file=sys.stderr)
+        return EXIT_ERROR
+
+    write_output(rows, args.format)
+    return EXIT_OK if complete else EXIT_PARTIAL
+
+
+if __name__ == "__main__":
+    sys.exit(main())
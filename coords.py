@@ -0,0 +1,213 @@
+"""
+Bulk RA / Dec to pixel conversion. Reads the WCS of a plate solved image once, then converts a whole list of
+targets and comparison stars in a single vectorized call.
+
+Usage:
+    python coords.py new-image.fits stars.csv
+    python coords.py new-image.fits stars.csv -o pixels.csv
+
+The CSV needs ra and dec columns and can have a name column. RA and Dec can be in degrees ( 286.81, 4.72 ) or
+sexagesimal ( 19:07:14, +04:43:12 or 19h07m14s, +04d43m12s ), with RA in hours. Use one format per file.
+"""
+
+import argparse
+import csv
+import os
+import sys
+from functools import lru_cache
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+import metrics
+
+# * Output columns.
+COLUMNS = ('name', 'ra', 'dec', 'x', 'y', 'in_bounds')
+
+# * Number of headers kept in memory by read_header().
+HEADER_CACHE_SIZE = 256
+
+# * Header keywords for the pointing, in the order they are tried.
+RA_DEC_KEYS = (('RA', 'DEC'), ('OBJCTRA', 'OBJCTDEC'), ('CRVAL1', 'CRVAL2'))
+
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _read_header(path, mtime_ns, size):
+    #  getheader only parses the first header and closes the file before returning, the data is never read.
+    with metrics.stage('fits_read', image=path):
+        return fits.getheader(path, memmap=True)
+
+
+def read_header(path):
+    """
+    Reads the primary header of a FITS file without touching its data.
+
+    Headers are cached on path, modification time and size, so reading the same frame again is free and a
+    frame that was rewritten is read again. The returned header is shared, so copy it before changing it.
+
+    Args:
+        path (str): Path to the FITS file or .wcs header.
+
+    Returns:
+        astropy.io.fits.Header: The primary header.
+    """
+    stat = os.stat(path)
+    return _read_header(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def load_wcs(solved_image):
+    """
+    Reads the WCS and image size of a plate solved image or a .wcs header file.
+
+    Like read_header(), the result is cached until the file changes, so converting star after star on the same
+    image only builds the WCS once.
+
+    Args:
+        solved_image (str): Path to the plate solved image ( new-image.fits ) or its WCS header.
+
+    Returns:
+        tuple: ( astropy.wcs.WCS, ( height, width ) ). The size is None if the header doesn't say.
+    """
+    stat = os.stat(solved_image)
+    return _load_wcs(os.path.abspath(solved_image), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _load_wcs(path, mtime_ns, size):
+    header = _read_header(path, mtime_ns, size)
+    return WCS(header), image_shape(header)
+
+
+def image_shape(header):
+    """ ( height, width ) of the image a header belongs to, or None if the header doesn't say. """
+    #  A plain image has NAXIS1 / NAXIS2, a .wcs file from astrometry.net only has IMAGEW / IMAGEH.
+    for width_key, height_key in (('NAXIS1', 'NAXIS2'), ('IMAGEW', 'IMAGEH')):
+        if header.get(width_key) and header.get(height_key):
+            return int(header[height_key]), int(header[width_key])
+    return None
+
+
+def header_radec(header):
+    """
+    Pointing of a frame from its header.
+
+    Numbers are taken as degrees, strings as sexagesimal hours ( RA ) and degrees ( Dec ).
+
+    Returns:
+        SkyCoord: Pointing of the frame, or None if the header doesn't have one.
+    """
+    for ra_key, dec_key in RA_DEC_KEYS:
+        if ra_key not in header or dec_key not in header:
+            continue
+        ra, dec = header[ra_key], header[dec_key]
+        try:
+            return SkyCoord(float(ra), float(dec), unit=u.deg)
+        except ValueError:
+            pass
+        try:
+            return SkyCoord(str(ra), str(dec), unit=(u.hourangle, u.deg))
+        except ValueError:
+            continue
+    return None
+
+
+def to_skycoord(ra, dec):
+    """
+    Builds one array SkyCoord from lists of RA and Dec values.
+
+    Numbers are taken as degrees, strings as sexagesimal hours ( RA ) and degrees ( Dec ).
+    """
+    try:
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+    except ValueError:
+        return SkyCoord(list(ra), list(dec), frame='fk5', unit=(u.hourangle, u.deg))
+    return SkyCoord(ra, dec, frame='fk5', unit=u.deg)
+
+
+def pixel_coords(wcs, ra, dec, shape=None):
+    """
+    Converts many RA / Dec values to pixel coordinates at once.
+
+    Args:
+        wcs (astropy.wcs.WCS): WCS of the plate solved image.
+        ra (list): Right ascension values, see to_skycoord().
+        dec (list): Declination values, see to_skycoord().
+        shape (tuple, optional): ( height, width ) of the image, used for the in bounds flags.
+
+    Returns:
+        tuple: ( x, y, in_bounds ) arrays. Pixel coordinates are 0 indexed. in_bounds is all True when no
+        shape is given, and False for stars that can't be projected onto the image at all.
+    """
+    with metrics.stage('pixel_coords', targets=np.size(ra)):
+        coords = to_skycoord(ra, dec)
+        x, y = wcs.world_to_pixel(coords)
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+
+    in_bounds = np.isfinite(x) & np.isfinite(y)
+    if shape is not None:
+        height, width = shape
+        # * Pixel centers are at whole numbers, so the image covers -0.5 to size - 0.5.
+        in_bounds &= (x >= -0.5) & (x < width - 0.5) & (y >= -0.5) & (y < height - 0.5)
+    return x, y, in_bounds
+
+
+def read_targets(csv_path):
+    """
+    Reads a CSV of targets.
+
+    Returns:
+        tuple: ( names, ra, dec ) lists. Rows without a name are named after their row number.
+    """
+    names, ra, dec = [], [], []
+    with open(csv_path, newline='') as f:
+        reader = csv.DictReader(f)
+        fields = {field.strip().lower(): field for field in reader.fieldnames or ()}
+        if 'ra' not in fields or 'dec' not in fields:
+            raise ValueError(f'{csv_path} needs ra and dec columns.')
+
+        for number, row in enumerate(reader, start=1):
+            names.append(row[fields['name']].strip() if 'name' in fields else str(number))
+            ra.append(row[fields['ra']].strip())
+            dec.append(row[fields['dec']].strip())
+    return names, ra, dec
+
+
+def convert_targets(solved_image, names, ra, dec):
+    """
+    Converts a list of targets to pixel coordinates on a plate solved image.
+
+    Returns:
+        list: One dict per target with the keys in COLUMNS.
+    """
+    wcs, shape = load_wcs(solved_image)
+    x, y, in_bounds = pixel_coords(wcs, ra, dec, shape)
+    return [dict(zip(COLUMNS, row)) for row in zip(names, ra, dec, x.tolist(), y.tolist(), in_bounds.tolist())]
+
+
+def write_rows(rows, f):
+    """ Writes converted targets as CSV. """
+    writer = csv.DictWriter(f, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a list of RA / Dec values to pixel coordinates.')
+    parser.add_argument('solved_image', help='Plate solved image ( new-image.fits ) or .wcs header.')
+    parser.add_argument('targets', help='CSV with ra and dec columns ( and optionally name ).')
+    parser.add_argument('-o', '--output', help='Write the CSV here instead of printing it.')
+    args = parser.parse_args(argv)
+
+    rows = convert_targets(args.solved_image, *read_targets(args.targets))
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_rows(rows, f)
+    else:
+        write_rows(rows, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
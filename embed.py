@@ -0,0 +1,225 @@
+"""
+Writes plate solutions into the headers of the original FITS files, so the frames themselves carry their WCS and no
+separate new-image.fits has to be kept.
+
+Only the WCS keywords of the solution are merged in, replacing any older WCS in the header. When the new header fits
+in the blocks the old one used ( FITS headers are padded to 2880 bytes, so there is usually room ), only the header
+is rewritten and the data is never touched. Otherwise the whole file is written to a temporary file next to it and
+swapped in with an atomic rename, so a crash never leaves a half written frame behind.
+
+The solution of each frame is read from the .wcs file next to it ( written by batch.py, watch.py, ... ) or, with
+--from-cache, from the solution cache.
+
+Usage:
+    python embed.py /path/to/night --workers 16
+    python embed.py frame1.fits frame2.fits --from-cache
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from astropy.io import fits
+import metrics
+from cache import SolutionCache, image_hash
+from solve import wcs_path_for
+from solvers import FITS_EXTENSIONS
+
+# * What happened to each file.
+IN_PLACE = 'in_place'
+REWRITTEN = 'rewritten'
+UNCHANGED = 'unchanged'
+NO_SOLUTION = 'no_solution'
+SKIPPED = 'skipped'
+
+# * Keywords that make up a celestial WCS, including SIP distortion. These are replaced as a set.
+WCS_KEY = re.compile(r'^(WCSAXES|WCSNAME|CTYPE\d|CRVAL\d|CRPIX\d|CUNIT\d|CDELT\d|CROTA\d|CD\d_\d|PC\d_\d|PV\d_\d+|'
+                     r'PS\d_\d+|LONPOLE|LATPOLE|RADESYS|EQUINOX|(A|B|AP|BP)_(ORDER|DMAX|\d+_\d+))$')
+
+HISTORY = 'WCS merged from a plate solution by autoastrometry'
+
+
+def wcs_cards(wcs_header):
+    """ The WCS cards of a solution header, without its structural keywords, comments and history. """
+    return [card for card in wcs_header.cards if WCS_KEY.match(card.keyword)]
+
+
+def merged_header(header, wcs_header):
+    """
+    A copy of header with its WCS replaced by the one in wcs_header.
+
+    Returns:
+        astropy.io.fits.Header: The new header, or None if header already has exactly this WCS.
+    """
+    cards = wcs_cards(wcs_header)
+    old = {card.keyword: card.value for card in header.cards if WCS_KEY.match(card.keyword)}
+    if old == {card.keyword: card.value for card in cards}:
+        return None
+
+    merged = header.copy()
+    for keyword in old:
+        merged.remove(keyword, remove_all=True)
+    for card in cards:
+        merged.append(card, end=True)
+    merged.add_history(HISTORY)
+    return merged
+
+
+def _image_index(hdul):
+    #  Decided from the headers alone, touching .data would map the pixels in.
+    for index, hdu in enumerate(hdul):
+        if hdu.is_image and hdu.header.get('NAXIS') == 2:
+            return index
+    raise ValueError(f'{hdul.filename()} has no 2D image.')
+
+
+def embed_wcs(image_path, wcs_header):
+    """
+    Merges a solution into the header of its FITS file.
+
+    Args:
+        image_path (str): FITS file to update.
+        wcs_header (astropy.io.fits.Header): Plate solution, as returned by solve.solve_image().
+
+    Returns:
+        str: IN_PLACE ( only the header was rewritten ), REWRITTEN ( the whole file was replaced ), UNCHANGED or
+        SKIPPED ( not a FITS file, or a tile compressed one ).
+    """
+    if not image_path.lower().endswith(FITS_EXTENSIONS):
+        return SKIPPED
+
+    with metrics.stage('fits_write', image=image_path) as fields:
+        #  The stored values are copied as they are, BZERO / BSCALE included. Scaling them ( and the strict memmap
+        #  that refuses scaled data ) would break the uint16 frames most cameras write.
+        with fits.open(image_path, do_not_scale_image_data=True) as hdul:
+            index = _image_index(hdul)
+            #  Writing a tile compressed image compresses the pixels again, which can change quantized data.
+            if isinstance(hdul[index], fits.CompImageHDU):
+                fields['mode'] = SKIPPED
+                return SKIPPED
+
+            header = merged_header(hdul[index].header, wcs_header)
+            if header is None:
+                fields['mode'] = UNCHANGED
+                return UNCHANGED
+            info = hdul.fileinfo(index)
+            room = info['datLoc'] - info['hdrLoc']
+
+            tmp_path = None
+            if len(header.tostring()) > room:
+                # * No room in the old header blocks, so write a new file and swap it in.
+                hdul[index].header = header
+                if 'CHECKSUM' in header:
+                    hdul[index].add_checksum(override_datasum=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(image_path)), suffix='.tmp')
+                os.close(fd)
+                try:
+                    hdul.writeto(tmp_path, overwrite=True)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+
+        if tmp_path is not None:
+            #  Swapped in once the original is closed, Windows won't replace an open file.
+            shutil.copymode(image_path, tmp_path)
+            os.replace(tmp_path, image_path)
+            fields['mode'] = REWRITTEN
+            return REWRITTEN
+
+        #  Blank cards keep the header exactly as long as before, which is what lets astropy leave the data alone.
+        while len(header.tostring()) < room:
+            header.append(fits.Card(), end=True)
+        with fits.open(image_path, mode='update', do_not_scale_image_data=True) as hdul:
+            hdul[index].header = header
+            if 'CHECKSUM' in header:
+                #  The data didn't change, so only the header checksum needs doing again.
+                hdul[index].add_checksum(override_datasum=True)
+        fields['mode'] = IN_PLACE
+    return IN_PLACE
+
+
+def solution_for(image_path, cache=None):
+    """
+    The solution of an image, from the .wcs next to it or else the solution cache.
+
+    Returns:
+        astropy.io.fits.Header: The solution, or None if there isn't one.
+    """
+    wcs_path = wcs_path_for(image_path)
+    if os.path.exists(wcs_path):
+        with metrics.stage('fits_read', image=wcs_path):
+            return fits.getheader(wcs_path)
+    if cache is not None:
+        return cache.get(image_hash(image_path))
+    return None
+
+
+def embed_one(image_path, cache=None):
+    """ Finds the solution of an image and merges it into its header, see embed_wcs(). """
+    wcs_header = solution_for(image_path, cache)
+    if not wcs_header:
+        return NO_SOLUTION
+    return embed_wcs(image_path, wcs_header)
+
+
+def embed_many(image_paths, workers=8, cache=None, on_result=None):
+    """
+    Merges solutions into many FITS files on a thread pool ( the work is almost all file I/O ).
+
+    Args:
+        image_paths (list): FITS files.
+        workers (int, optional): Files worked on at once.
+        cache (cache.SolutionCache, optional): Where to look for solutions of images without a .wcs.
+        on_result (callable, optional): Called as on_result(image_path, status, error) as each file finishes.
+
+    Returns:
+        dict: Maps every image path to its status ( see embed_wcs() ), or None if it failed.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(embed_one, image_path, cache): image_path for image_path in image_paths}
+        for future in as_completed(futures):
+            image_path = futures[future]
+            status = error = None
+            try:
+                status = future.result()
+            except Exception as e:
+                error = e
+            results[image_path] = status
+            if on_result:
+                on_result(image_path, status, error)
+    return results
+
+
+def print_status(image_path, status, error):
+    """ Prints one line per finished file. """
+    if error:
+        print(f'FAILED     {image_path}: {error}')
+    else:
+        print(f'{status.upper():<10} {image_path}')
+
+
+def main(argv=None):
+    from api import expand_paths
+
+    parser = argparse.ArgumentParser(description='Write plate solutions into the headers of the original FITS files.')
+    parser.add_argument('paths', nargs='+', help='FITS files and / or directories of them.')
+    parser.add_argument('--workers', type=int, default=8, help='Files worked on at once ( default: 8 ).')
+    parser.add_argument('--from-cache', action='store_true',
+                        help='Look in the solution cache for images without a .wcs next to them.')
+    args = parser.parse_args(argv)
+
+    image_paths = [path for path in expand_paths(args.paths) if path.lower().endswith(FITS_EXTENSIONS)]
+    results = embed_many(image_paths, args.workers, SolutionCache() if args.from_cache else None, print_status)
+    statuses = list(results.values())
+    print(f'\n{statuses.count(IN_PLACE)} in place, {statuses.count(REWRITTEN)} rewritten, '
+          f'{statuses.count(UNCHANGED)} unchanged, {statuses.count(SKIPPED)} skipped, '
+          f'{statuses.count(NO_SOLUTION)} without a solution, {statuses.count(None)} failed.')
+    return 0 if None not in statuses else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
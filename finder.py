@@ -1,7 +1,8 @@
-from astroquery.simbad import Simbad
-from time import sleep as s
-import webbrowser
+from astropy.coordinates import SkyCoord
 from rich import print
+from resolver import NameCache, resolve
+
+SIMBAD_URL = 'http://simbad.u-strasbg.fr/simbad/sim-fbasic'
 
 
 def ask_for(prompt, error_msg=None, _type=None):
@@ -36,41 +37,48 @@ class Finder():
 
     def find_target(self):
         """
-        Finds target with SIMBAD query. It can also look up multiple objects.
+        Finds target with SIMBAD query. It can also look up multiple objects, in which case every name is asked for
+        first and they are all looked up together.
         """
 
         # User is querying more than one object
         if self.multiple_queries > 1:
+            names = []
+            print(
+                '\nThese prompts [bold blue]will repeat for every target you have[/].')
             for _ in range(self.multiple_queries):
-                print(
-                    '\nThese prompts [bold blue]will repeat for every target you have[/].')
-                self.target_name = ask_for(
-                    '\nTarget name: ', 'Not a string', str)
-                print('\n[bold]Looking up target...[/]')
-                try:
-                    query = Simbad.query_object(self.target_name)
-                    print('\n[bold blue]Target found[/]! Information below:')
-                    s(0.25)
-                    query.pprint()
-                except:
-                    print('\nTarget could not be found, opening website.')
-                    s(1.5)
-                    webbrowser.open(
-                        'http://simbad.u-strasbg.fr/simbad/sim-fbasic')
+                names.append(ask_for(
+                    '\nTarget name: ', 'Not a string', str))
 
         # User is only going to query one object
-        elif self.multiple_queries == 1:
-            print('\n[bold]Looking up target...[/]')
-            try:
-                query = Simbad.query_object(self.target_name)
-                print('\n[bold blue]Target found[/]! Information below:')
-                s(0.25)
-                query.pprint()
-            except:
-                print('\nTarget could not be found, opening website.')
-                s(1.5)
-                webbrowser.open(
-                    'http://simbad.u-strasbg.fr/simbad/sim-fbasic')
+        else:
+            names = [self.target_name]
+
+        print('\n[bold]Looking up targets...[/]' if len(names) > 1 else '\n[bold]Looking up target...[/]')
+        results = self.find_targets(names)
+
+        for name, target in results.items():
+            if target is None:
+                print(f'\n[red]{name}[/] could not be found.')
+                continue
+            coord = SkyCoord(target['ra'], target['dec'], unit='deg')
+            print(f'\n[bold blue]{name}[/] found! ( {target["main_id"]} )')
+            print(f'RA: {coord.ra.to_string(unit="hourangle", sep=" ", precision=2)}  '
+                  f'Dec: {coord.dec.to_string(sep=" ", precision=1, alwayssign=True)}')
+
+        if not all(results.values()):
+            print(f'\nTry looking those up on the website: {SIMBAD_URL}')
+        return results
+
+    @staticmethod
+    def find_targets(names):
+        """
+        Looks up a list of target names in one SIMBAD query, without any prompts. Answers are cached locally.
+
+        Returns:
+            dict: Maps every name to a dict with name, main_id, ra and dec ( degrees ), or None if it wasn't found.
+        """
+        return resolve(names, cache=NameCache())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+"""
+Solve hints from FITS headers. Most capture programs write the mount pointing, focal length and pixel size into
+every frame, which pins down where on the sky and at what scale the solver has to look. A hinted solve searches a
+few square degrees at one scale instead of the whole sky at every scale.
+
+    Pointing:     RA / DEC, OBJCTRA / OBJCTDEC or CRVAL1 / CRVAL2, or else the SIMBAD position of OBJECT
+    Plate scale:  PIXSCALE / SCALE / SECPIX, or else pixel size ( XPIXSZ, PIXSIZE1 ) and focal length ( FOCALLEN )
+
+The mount pointing is preferred over the target position, because the target doesn't have to be in the middle of
+the frame.
+
+Usage:
+    python hints.py frame.fits
+    python hints.py frame.fits --target "M 13"
+"""
+
+import argparse
+import json
+import sys
+import threading
+import numpy as np
+from astropy.coordinates import SkyCoord
+from coords import header_radec, image_shape, read_header
+from solvers import FITS_EXTENSIONS
+
+# * Header keywords for the plate scale ( arcsec / pixel ), pixel size ( microns, after binning ) and focal
+# * length ( mm ), in the order they are tried.
+SCALE_KEYS = ('PIXSCALE', 'SCALE', 'SECPIX', 'SECPIX1')
+PIXEL_SIZE_KEYS = ('XPIXSZ', 'PIXSIZE1', 'PIXSIZE')
+FOCAL_LENGTH_KEYS = ('FOCALLEN', 'FOCAL')
+
+# * How far off the header plate scale may be ( fraction ), and how far off the pointing ( degrees ).
+SCALE_TOLERANCE = 0.2
+POINTING_ERROR = 1.0
+
+# * Search radius ( degrees ) when the field size isn't known.
+DEFAULT_RADIUS = 5.0
+
+
+def _first_positive(header, keys):
+    for key in keys:
+        try:
+            value = float(header[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if value > 0:
+            return value
+    return None
+
+
+def plate_scale(header):
+    """
+    Plate scale from a header.
+
+    Returns:
+        float: Arcseconds per pixel, or None if the header doesn't say.
+    """
+    scale = _first_positive(header, SCALE_KEYS)
+    if scale:
+        return scale
+    pixel_size, focal_length = _first_positive(header, PIXEL_SIZE_KEYS), _first_positive(header, FOCAL_LENGTH_KEYS)
+    if pixel_size and focal_length:
+        # * 206.265 arcsec per radian / 1000, for microns over millimetres.
+        return 206.264806 * pixel_size / focal_length
+    return None
+
+
+def search_radius(scale, shape):
+    """ Degrees around the pointing to search: half the field diagonal plus the pointing error. """
+    if not scale or not shape:
+        return DEFAULT_RADIUS
+    return float(np.hypot(*shape) * scale / 3600 / 2 + POINTING_ERROR)
+
+
+def header_hints(header, target_position=None):
+    """
+    Solver settings from a header.
+
+    Args:
+        header (astropy.io.fits.Header): Header of the frame.
+        target_position (SkyCoord, optional): Used when the header has no pointing.
+
+    Returns:
+        dict: Any of center_ra, center_dec, radius ( degrees ), scale_units, scale_type, scale_lower and
+        scale_upper, as taken by nova.astrometry.net.
+    """
+    hints = {}
+    scale = plate_scale(header)
+    if scale:
+        hints.update(scale_units='arcsecperpix', scale_type='ul', scale_lower=scale * (1 - SCALE_TOLERANCE),
+                     scale_upper=scale * (1 + SCALE_TOLERANCE))
+
+    center = header_radec(header)
+    if center is None:
+        center = target_position
+    if center is not None:
+        hints.update(center_ra=float(center.ra.deg), center_dec=float(center.dec.deg),
+                     radius=search_radius(scale, image_shape(header)))
+    return hints
+
+
+class TargetLookup():
+    """
+    SIMBAD positions of target names for one run, shared by every frame in it. A night of frames of the same
+    target costs one lookup, and so does an OBJECT SIMBAD doesn't know ( 'Light', 'flat', ... ), which the name
+    cache doesn't keep.
+
+    Args:
+        name_cache (resolver.NameCache, optional): Cache for the SIMBAD lookups, defaults to the one on disk.
+    """
+
+    def __init__(self, name_cache=None):
+        self.name_cache = name_cache
+        self._positions = {}
+        #  Held during the lookup, so workers that all start on the same target don't all ask SIMBAD.
+        self._lock = threading.Lock()
+
+    def position(self, name):
+        """
+        Looks up a name.
+
+        Returns:
+            SkyCoord: Position of the target, or None if SIMBAD doesn't know it or couldn't be reached.
+        """
+        with self._lock:
+            if name not in self._positions:
+                from resolver import NameCache, resolve
+
+                if self.name_cache is None:
+                    self.name_cache = NameCache()
+                #  A failed lookup only costs the hint, the image can still be solved blind.
+                try:
+                    found = resolve([name], cache=self.name_cache)[name]
+                except Exception:
+                    found = None
+                self._positions[name] = SkyCoord(found['ra'], found['dec'], unit='deg') if found else None
+            return self._positions[name]
+
+
+def solve_hints(image_path, target=None, name_cache=None, lookup=None):
+    """
+    Solver settings for an image, from its header and ( if the header has no pointing ) SIMBAD.
+
+    Args:
+        image_path (str): Path to the image. Only FITS files have headers, anything else gets no hints.
+        target (str, optional): Target name, defaults to the OBJECT keyword.
+        name_cache (resolver.NameCache, optional): Cache for the SIMBAD lookup.
+        lookup (TargetLookup, optional): Lookups shared with the other frames of a run, instead of name_cache.
+
+    Returns:
+        dict: See header_hints(), empty if nothing is known.
+    """
+    if not image_path.lower().endswith(FITS_EXTENSIONS):
+        return {}
+    header = read_header(image_path)
+
+    target_position = None
+    name = target or str(header.get('OBJECT', '')).strip()
+    if name and header_radec(header) is None:
+        target_position = (lookup or TargetLookup(name_cache)).position(name)
+    return header_hints(header, target_position)
+
+
+def for_upload(hints, factor):
+    """ Hints for an upload binned by factor ( the plate scale grows with the binning ). """
+    if not hints or factor == 1 or 'scale_lower' not in hints:
+        return hints
+    return dict(hints, scale_lower=hints['scale_lower'] * factor, scale_upper=hints['scale_upper'] * factor)
+
+
+def main(argv=None):
+    from resolver import NameCache
+
+    parser = argparse.ArgumentParser(description='Show the solve hints found in a FITS header.')
+    parser.add_argument('image', help='FITS image.')
+    parser.add_argument('--target', help='Target name to look up if the header has no pointing.')
+    args = parser.parse_args(argv)
+
+    hints = solve_hints(args.image, target=args.target, name_cache=NameCache())
+    print(json.dumps(hints, indent=2))
+    return 0 if hints else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
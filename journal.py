@@ -0,0 +1,162 @@
+"""
+Local journal of nova.astrometry.net submissions. Every submission ID is written down as soon as the upload
+returns, so a crash or Ctrl-C never loses it. On the next run pending submissions are monitored again instead of
+being uploaded a second time.
+
+Usage:
+    python journal.py            ( lists pending submissions )
+    python journal.py --resume   ( finishes every pending submission )
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from cache import SolutionCache
+from preprocess import UploadTransform
+from solve import SOLVE_TIMEOUT, write_wcs
+from solvers import AstrometryNetSolver
+
+# * Default journal location.
+JOURNAL_PATH = os.environ.get('AUTOASTROMETRY_JOURNAL',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'autoastrometry', 'journal.sqlite'))
+
+# * Submission states.
+SUBMITTED = 'submitted'
+SOLVED = 'solved'
+FAILED = 'failed'
+
+
+class SubmissionJournal():
+    """
+    SQLite backed record of submissions, one row per image hash.
+
+    A new connection is opened for every call, so one journal can be shared by threads and by several processes.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS submissions (
+                    image_hash TEXT PRIMARY KEY,
+                    image_path TEXT NOT NULL,
+                    submission_id INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, image_hash, image_path, submission_id, state=SUBMITTED):
+        """
+        Writes down a submission ( or updates it if the image was submitted before ).
+
+        Args:
+            image_hash (str): Hash of the image pixel data, from cache.image_hash().
+            image_path (str): Path to the image.
+            submission_id (int): Submission ID returned by nova.astrometry.net.
+            state (str, optional): One of SUBMITTED, SOLVED or FAILED.
+        """
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?)',
+                       (image_hash, image_path, int(submission_id), state, time.time()))
+
+    def finish(self, image_hash, solved):
+        """ Marks a submission as solved or failed. """
+        with self._connect() as db:
+            db.execute('UPDATE submissions SET state = ?, updated = ? WHERE image_hash = ?',
+                       (SOLVED if solved else FAILED, time.time(), image_hash))
+
+    def pending_submission(self, image_hash):
+        """
+        Looks up an unfinished submission for an image.
+
+        Returns:
+            int: Submission ID that is still being solved, or None.
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT submission_id FROM submissions WHERE image_hash = ? AND state = ?',
+                             (image_hash, SUBMITTED)).fetchone()
+        return row[0] if row else None
+
+    def pending(self):
+        """
+        Every unfinished submission.
+
+        Returns:
+            list: ( image hash, image path, submission ID ) tuples, oldest first.
+        """
+        with self._connect() as db:
+            return db.execute('SELECT image_hash, image_path, submission_id FROM submissions '
+                              'WHERE state = ? ORDER BY updated', (SUBMITTED,)).fetchall()
+
+    def state(self, image_hash):
+        """ State of the submission for an image, or None if it was never submitted. """
+        with self._connect() as db:
+            row = db.execute('SELECT state FROM submissions WHERE image_hash = ?', (image_hash,)).fetchone()
+        return row[0] if row else None
+
+
+def resume_pending(journal, solve_timeout=SOLVE_TIMEOUT, cache=None):
+    """
+    Monitors every pending submission until it finishes and writes its WCS header next to the image. A submission
+    that is still running after solve_timeout seconds is left pending.
+
+    Args:
+        journal (SubmissionJournal): Journal holding the pending submissions.
+        solve_timeout (int, optional): Seconds to wait on each submission.
+        cache (cache.SolutionCache, optional): Cache the finished solutions are stored in.
+
+    Returns:
+        dict: Maps every image path to its WCS header path, or None if it could not be solved.
+    """
+    solver = AstrometryNetSolver()
+    results = {}
+    for key, image_path, submission_id in journal.pending():
+        try:
+            wcs_header = solver.monitor(submission_id, solve_timeout)
+        except TimeoutError:
+            #  Still running on nova.astrometry.net, so it stays pending for the next resume.
+            results[image_path] = None
+            continue
+        journal.finish(key, bool(wcs_header))
+
+        #  Shrunk uploads carry their transform after the hash ( see solve.solve_image() ).
+        image_key, _, signature = key.partition(':')
+        if signature:
+            wcs_header = UploadTransform.from_signature(signature).to_original(wcs_header)
+        if wcs_header:
+            if cache is not None:
+                cache.put(image_key, wcs_header)
+            results[image_path] = write_wcs(wcs_header, image_path)
+        else:
+            results[image_path] = None
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show or resume pending nova.astrometry.net submissions.')
+    parser.add_argument('--journal', default=JOURNAL_PATH, help=f'Journal file ( default: {JOURNAL_PATH} ).')
+    parser.add_argument('--resume', action='store_true', help='Monitor every pending submission until it finishes.')
+    args = parser.parse_args(argv)
+
+    journal = SubmissionJournal(args.journal)
+    if not args.resume:
+        for _, image_path, submission_id in journal.pending():
+            print(f'{submission_id}  {image_path}')
+        return 0
+
+    results = resume_pending(journal, cache=SolutionCache())
+    for image_path, wcs_path in results.items():
+        print(f'SOLVED  {image_path} -> {wcs_path}' if wcs_path else f'FAILED  {image_path}')
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Per-stage timings and counters, to find out where the time of a slow night actually goes.
+
+Every stage of a solve or lookup is timed and added to in-memory totals. The totals can be written as a Prometheus
+text file ( for node_exporter's textfile collector ) or served over HTTP. Each timing can also be appended to a
+JSON-lines trace file, one line per stage with the image or names it was working on.
+
+    Stages:    hash, fits_read, fits_write, preprocess, upload, queue_wait, solve, wcs_download, simbad, pixel_coords,
+               catalog_query, watch_latency
+    Counters:  submissions, cache_hits, cache_misses, retries, timeouts, blind_retries, simbad_queries,
+               name_cache_hits
+
+The trace and metrics files are off unless AUTOASTROMETRY_TRACE / AUTOASTROMETRY_METRICS name them ( or
+configure() is called ). The metrics file is written when the program exits.
+
+Usage:
+    AUTOASTROMETRY_TRACE=trace.jsonl AUTOASTROMETRY_METRICS=autoastrometry.prom python batch.py /path/to/night
+"""
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# * Trace and metrics files, off unless set.
+TRACE_PATH = os.environ.get('AUTOASTROMETRY_TRACE')
+METRICS_PATH = os.environ.get('AUTOASTROMETRY_METRICS')
+
+# * Prefix of every Prometheus metric, and the upper bounds ( seconds ) of the stage histogram buckets.
+PREFIX = 'autoastrometry'
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+
+class Metrics():
+    """
+    Thread safe stage timings and counters.
+
+    Args:
+        trace_path (str, optional): JSON-lines file every timing is appended to.
+        metrics_path (str, optional): Prometheus text file written by write_metrics().
+    """
+
+    def __init__(self, trace_path=None, metrics_path=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._trace = None
+        self.reset()
+
+    def reset(self):
+        """ Forgets every timing and counter. """
+        with self._lock:
+            self.counters = {}
+            #  stage -> [ count, total seconds, count per bucket ]
+            self.stages = {}
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Times the code in a with block as one stage.
+
+        Args:
+            name (str): Stage name.
+            **fields: Extra values for the trace line ( image path, submission ID, ... ). The block can add more
+                to the dict it gets back.
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield fields
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, error=error, **fields)
+
+    def observe(self, name, seconds, error=None, **fields):
+        """ Records a stage that was timed some other way. """
+        with self._lock:
+            totals = self.stages.setdefault(name, [0, 0.0, [0] * len(BUCKETS)])
+            totals[0] += 1
+            totals[1] += seconds
+            for number, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    totals[2][number] += 1
+            if self.trace_path:
+                line = {'time': time.time(), 'stage': name, 'seconds': round(seconds, 6), 'pid': os.getpid(),
+                        'thread': threading.current_thread().name, 'error': error, **fields}
+                self._write_trace(json.dumps(line, default=str))
+
+        for hook in self.hooks:
+            hook(name, seconds, fields)
+
+    def count(self, name, amount=1):
+        """ Adds to a counter. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_hook(self, hook):
+        """ Calls hook(stage, seconds, fields) after every timed stage. """
+        self.hooks.append(hook)
+
+    def _write_trace(self, line):
+        if self._trace is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.trace_path)), exist_ok=True)
+            self._trace = open(self.trace_path, 'a', buffering=1)
+        self._trace.write(line + '\n')
+
+    def prometheus(self):
+        """ Every timing and counter in the Prometheus text format. """
+        with self._lock:
+            stages = {name: (totals[0], totals[1], list(totals[2])) for name, totals in self.stages.items()}
+            counters = dict(self.counters)
+
+        lines = [f'# HELP {PREFIX}_stage_seconds Time spent in each stage.',
+                 f'# TYPE {PREFIX}_stage_seconds histogram']
+        for name, (count, total, buckets) in sorted(stages.items()):
+            for bound, in_bucket in zip(BUCKETS, buckets):
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {in_bucket}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {count}')
+        for name, value in sorted(counters.items()):
+            lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+            lines.append(f'{PREFIX}_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self, path=None):
+        """ Writes prometheus() to a file, swapped in whole so a collector never reads half of it. """
+        path = path or self.metrics_path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host=''):
+        """
+        Serves prometheus() at http://host:port/metrics from a background thread.
+
+        Returns:
+            http.server.ThreadingHTTPServer: The running server, shutdown() stops it.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        """ Writes the metrics file ( if there is one ) and closes the trace. """
+        if self.metrics_path:
+            self.write_metrics()
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+
+# * Shared by every module, so one program has one set of totals.
+METRICS = Metrics(TRACE_PATH, METRICS_PATH)
+stage = METRICS.stage
+observe = METRICS.observe
+count = METRICS.count
+atexit.register(METRICS.close)
+
+
+def configure(trace_path=None, metrics_path=None):
+    """ Turns on the trace and / or metrics file of the shared METRICS. """
+    if trace_path:
+        METRICS.trace_path = trace_path
+    if metrics_path:
+        METRICS.metrics_path = metrics_path
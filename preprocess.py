@@ -0,0 +1,260 @@
+"""
+Shrinks FITS images before they are uploaded. Large sensors have far more pixels than a plate solver needs, so the
+image is binned ( block averaged ), optionally cropped to its centre and re-encoded as an 8 bit PNG or a Rice tile
+compressed FITS file. The WCS that comes back describes the small image and is mapped back onto the original pixel
+grid with UploadTransform.to_original().
+
+With a byte budget the smallest binning that fits is picked, and if even the coarsest binning is too big the image
+is cropped to its centre as well.
+
+PNG and JPEG images are already compressed and are uploaded as they are.
+
+Usage:
+    python preprocess.py frame.fits --max-upload-mb 2 -o small.png
+"""
+
+import argparse
+import io
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+from astropy.io import fits
+import metrics
+from sources import image_hdu
+
+# * Largest binning factor tried when fitting a byte budget.
+MAX_FACTOR = 8
+
+# * Smallest width or height ( binned pixels ) a crop may leave to fit a budget, less has too few stars to solve.
+MIN_UPLOAD_SIDE = 64
+
+# * Upload formats.
+FORMATS = ('png', 'fits')
+
+# * Percentiles mapped to black and white in PNG uploads.
+PNG_LIMITS = (5.0, 99.9)
+
+
+class UploadTransform():
+    """
+    How an uploaded image relates to the original one: the original was cropped to start at pixel ( x0, y0 )
+    ( 0 indexed ) and binned by factor. width and height are the size of the original image.
+    """
+
+    def __init__(self, factor, x0, y0, width, height):
+        self.factor = int(factor)
+        self.x0 = int(x0)
+        self.y0 = int(y0)
+        self.width = int(width)
+        self.height = int(height)
+
+    def signature(self):
+        """ Short text form, used to tell journal entries of differently prepared uploads apart. """
+        return f'{self.factor}-{self.x0}-{self.y0}-{self.width}-{self.height}'
+
+    @classmethod
+    def from_signature(cls, signature):
+        return cls(*(int(value) for value in signature.split('-')))
+
+    def to_original(self, wcs_header):
+        """
+        Maps a WCS header solved on the uploaded image onto the original image.
+
+        The reference pixel is moved and scaled, the CD ( or CDELT ) matrix is divided by the binning factor and
+        SIP distortion coefficients are rescaled to original pixels.
+
+        Returns:
+            astropy.io.fits.Header: New header for the original image, or the header unchanged if it is empty.
+        """
+        if not wcs_header:
+            return wcs_header
+        header = wcs_header.copy()
+        f = self.factor
+
+        # * A binned pixel p ( 1 indexed ) covers original pixels centred on offset + ( p - 0.5 ) * f + 0.5.
+        for axis, offset in ((1, self.x0), (2, self.y0)):
+            if f'CRPIX{axis}' in header:
+                header[f'CRPIX{axis}'] = offset + (header[f'CRPIX{axis}'] - 0.5) * f + 0.5
+
+        if any(key in header for key in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')):
+            for key in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2'):
+                if key in header:
+                    header[key] = header[key] / f
+        else:
+            for key in ('CDELT1', 'CDELT2'):
+                if key in header:
+                    header[key] = header[key] / f
+
+        #  SIP polynomials work on pixel offsets, which are f times larger in the original image.
+        for prefix in ('A', 'B', 'AP', 'BP'):
+            for key in list(header.keys()):
+                parts = key.split('_')
+                if len(parts) == 3 and parts[0] == prefix and parts[1].isdigit() and parts[2].isdigit():
+                    header[key] = header[key] * f ** (1 - int(parts[1]) - int(parts[2]))
+
+        if 'IMAGEW' in header:
+            header['IMAGEW'] = self.width
+        if 'IMAGEH' in header:
+            header['IMAGEH'] = self.height
+        header['HISTORY'] = f'WCS solved on a {f}x{f} binned upload cropped at ({self.x0}, {self.y0})'
+        return header
+
+
+def block_reduce(data, factor):
+    """ Averages factor x factor blocks. Rows and columns that don't fill a whole block are dropped. """
+    if factor == 1:
+        return data
+    height, width = data.shape[0] // factor * factor, data.shape[1] // factor * factor
+    blocks = data[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def central_crop(data, fraction):
+    """
+    Keeps the central fraction of the width and height.
+
+    Returns:
+        tuple: ( cropped data, x0, y0 ), where x0 and y0 are the 0 indexed position of the crop in data.
+    """
+    if fraction >= 1:
+        return data, 0, 0
+    height, width = data.shape
+    crop_height, crop_width = max(int(height * fraction), 1), max(int(width * fraction), 1)
+    y0, x0 = (height - crop_height) // 2, (width - crop_width) // 2
+    return data[y0:y0 + crop_height, x0:x0 + crop_width], x0, y0
+
+
+def png_bytes(data, limits=PNG_LIMITS):
+    """
+    Encodes an image as an 8 bit greyscale PNG, mapping the limits percentiles to black and white.
+
+    Rows are written in array order, so PNG row 1 is FITS row 1 and the solution keeps the same pixel numbering.
+    """
+    finite = np.isfinite(data)
+    sample = data[::4, ::4][finite[::4, ::4]]
+    low, high = np.percentile(sample, limits) if sample.size else (0.0, 1.0)
+    scaled = (np.where(finite, data, low) - low) * (255.0 / max(high - low, 1e-12))
+    image = np.clip(scaled, 0, 255).astype(np.uint8)
+
+    #  Sub filter ( difference from the pixel to the left ) compresses smooth sky much better than raw rows.
+    rows = np.diff(image, axis=1, prepend=np.uint8(0))
+    raw = np.hstack([np.ones((image.shape[0], 1), np.uint8), rows]).tobytes()
+
+    def chunk(tag, payload):
+        return struct.pack('>I', len(payload)) + tag + payload + struct.pack('>I', zlib.crc32(tag + payload))
+
+    header = struct.pack('>IIBBBBB', image.shape[1], image.shape[0], 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 6))
+            + chunk(b'IEND', b''))
+
+
+def fits_bytes(data):
+    """ Encodes an image as a Rice tile compressed FITS file. """
+    f = io.BytesIO()
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(np.asarray(data, np.float32),
+                                                              compression_type='RICE_1', quantize_level=16)])
+    hdul.writeto(f)
+    return f.getvalue()
+
+
+def encode(data, fmt):
+    return png_bytes(data) if fmt == 'png' else fits_bytes(data)
+
+
+def read_image(image_path):
+    """ First 2D image in a FITS file as float32, with BZERO / BSCALE applied. """
+    #  No explicit memmap=True, it makes astropy refuse scaled data like the uint16 frames most cameras write.
+    with fits.open(image_path) as hdul:
+        return np.asarray(image_hdu(hdul, image_path).data, dtype=np.float32)
+
+
+class Preprocessor():
+    """
+    Prepares images for upload.
+
+    Args:
+        max_upload_mb (float, optional): Byte budget of an upload in MiB. Files already under it are uploaded as
+            they are, bigger ones are binned ( and cropped if binning alone isn't enough ) until they fit.
+        factor (int, optional): Fixed binning factor. Default is 1 without a budget, or the smallest that fits.
+        crop (float, optional): Central fraction of the width and height to keep ( 0 - 1 ).
+        fmt (str, optional): 'png' ( 8 bit, smallest ) or 'fits' ( Rice compressed, keeps more dynamic range ).
+    """
+
+    def __init__(self, max_upload_mb=None, factor=None, crop=None, fmt='png'):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown upload format {fmt}, use one of {FORMATS}')
+        self.max_bytes = max_upload_mb * 2 ** 20 if max_upload_mb else None
+        self.factor = factor
+        self.crop = crop
+        self.fmt = fmt
+
+    def prepare(self, image_path, out_dir):
+        """
+        Writes the upload for an image into out_dir.
+
+        Returns:
+            tuple: ( path to upload, UploadTransform or None if the original should be uploaded as it is ).
+        """
+        if not image_path.lower().endswith(('.fits', '.fit', '.fts')):
+            return image_path, None
+        if self.max_bytes and not self.factor and not self.crop and os.path.getsize(image_path) <= self.max_bytes:
+            return image_path, None
+
+        with metrics.stage('preprocess', image=image_path) as fields:
+            data = read_image(image_path)
+            height, width = data.shape
+            cropped, x0, y0 = central_crop(data, self.crop or 1)
+
+            factors = [self.factor] if self.factor else range(1, MAX_FACTOR + 1) if self.max_bytes else [1]
+            for factor in factors:
+                encoded = encode(block_reduce(cropped, factor), self.fmt)
+                if not self.max_bytes or len(encoded) <= self.max_bytes:
+                    break
+            else:
+                # * Even the coarsest binning is too big, so keep a central part that fits. Noise doesn't compress
+                # * as well as sky, so the size doesn't go down exactly with the area and it can take a few cuts.
+                while len(encoded) > self.max_bytes:
+                    fraction = 0.95 * np.sqrt(self.max_bytes / len(encoded))
+                    if min(cropped.shape) * fraction < MIN_UPLOAD_SIDE * factor:
+                        raise ValueError(f"{image_path} can't be shrunk under {self.max_bytes / 2 ** 20:g} MiB "
+                                         f'without cropping it too small to solve.')
+                    cropped, crop_x0, crop_y0 = central_crop(cropped, fraction)
+                    x0, y0 = x0 + crop_x0, y0 + crop_y0
+                    encoded = encode(block_reduce(cropped, factor), self.fmt)
+
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            upload_path = os.path.join(out_dir, f'{stem}-upload.{self.fmt}')
+            with open(upload_path, 'wb') as f:
+                f.write(encoded)
+            fields.update(factor=factor, bytes_in=os.path.getsize(image_path), bytes_out=len(encoded))
+        return upload_path, UploadTransform(factor, x0, y0, width, height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shrink a FITS image the way it would be uploaded.')
+    parser.add_argument('image', help='FITS image.')
+    parser.add_argument('-o', '--output', help='Where to write the upload ( default: next to the image ).')
+    parser.add_argument('--max-upload-mb', type=float, help='Byte budget of the upload in MiB.')
+    parser.add_argument('--bin', type=int, dest='factor', help='Fixed binning factor.')
+    parser.add_argument('--crop', type=float, help='Central fraction of the width and height to keep.')
+    parser.add_argument('--format', choices=FORMATS, default='png', dest='fmt')
+    args = parser.parse_args(argv)
+
+    preprocessor = Preprocessor(args.max_upload_mb, args.factor, args.crop, args.fmt)
+    out_dir = os.path.dirname(os.path.abspath(args.output or args.image))
+    upload_path, transform = preprocessor.prepare(args.image, out_dir)
+    if transform is None:
+        print(f'{args.image} is already under the budget, it would be uploaded as it is.')
+        return 0
+    if args.output:
+        os.replace(upload_path, args.output)
+        upload_path = args.output
+    print(f'{args.image}: {os.path.getsize(args.image)} bytes -> {upload_path}: {os.path.getsize(upload_path)} bytes '
+          f'( bin {transform.factor}, crop at {transform.x0}, {transform.y0} )')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Batched SIMBAD name resolver. A whole list of target names is resolved with one SIMBAD query ( split into chunks
+for very long lists ), and every answer is kept in a local cache, so resolving an observing list again only asks
+SIMBAD about the names it hasn't seen recently.
+
+Usage:
+    python resolver.py M13 Vega "Kepler-1"
+    python resolver.py --file targets.txt
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astroquery.simbad import Simbad, SimbadClass
+import metrics
+
+# * Default cache location and how long answers are trusted ( seconds ).
+NAME_CACHE_PATH = os.environ.get('AUTOASTROMETRY_NAME_CACHE',
+                                 os.path.join(os.path.expanduser('~'), '.cache', 'autoastrometry', 'names.json'))
+NAME_CACHE_TTL = 30 * 24 * 3600
+
+# * Names sent to SIMBAD in one query.
+CHUNK_SIZE = 1000
+
+# * Output columns.
+COLUMNS = ('name', 'main_id', 'ra', 'dec')
+
+# * SIMBAD TAP service, can be pointed somewhere else ( a mirror or a test server ) with SIMBAD_TAP_URL.
+SIMBAD_TAP_URL = os.environ.get('SIMBAD_TAP_URL')
+
+# * Most rows asked of a SIMBAD_TAP_URL service ( the real SIMBAD tells astroquery its own limit ).
+MIRROR_HARDLIMIT = 2000000
+
+
+def normalize(name):
+    """ Cache key of a target name ( case and extra spaces don't matter ). """
+    return ' '.join(name.split()).lower()
+
+
+class NameCache():
+    """
+    JSON file of resolved names with a time to live. Only names SIMBAD found are stored, so a typo can be fixed
+    and looked up again straight away.
+    """
+
+    def __init__(self, path=NAME_CACHE_PATH, ttl=NAME_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def get(self, name):
+        """
+        Looks up a name.
+
+        Returns:
+            dict: The cached target ( see COLUMNS ), or None if it isn't cached or has expired.
+        """
+        entry = self.entries.get(normalize(name))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return dict(entry['target'], name=name)
+
+    def put(self, targets):
+        """ Stores resolved targets and saves the cache. """
+        with self._lock:
+            now = time.time()
+            for target in targets:
+                self.entries[normalize(target['name'])] = {'time': now, 'target': target}
+            self._save()
+
+    def clear(self):
+        """ Forgets every name. """
+        with self._lock:
+            self.entries = {}
+            self._save()
+
+    def _save(self):
+        #  Writes to a temporary file first so a crash never leaves half a cache behind.
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class SimbadMirror(SimbadClass):
+    """ astroquery's SIMBAD client, talking to a TAP service at another URL. """
+
+    def __init__(self, tap_url):
+        super().__init__()
+        self.tap_url = tap_url
+
+    @property
+    def tap(self):
+        from pyvo.dal import TAPService
+
+        if self._tap is None:
+            self._tap = TAPService(baseurl=self.tap_url, session=self._session)
+        return self._tap
+
+    @property
+    def hardlimit(self):
+        return MIRROR_HARDLIMIT
+
+
+_simbad = SimbadMirror(SIMBAD_TAP_URL) if SIMBAD_TAP_URL else Simbad
+
+
+def query_simbad(names):
+    """
+    Resolves a list of names with a single SIMBAD query.
+
+    Returns:
+        dict: Maps every name to its target ( see COLUMNS ), or None if SIMBAD didn't find it.
+    """
+    metrics.count('simbad_queries')
+    with metrics.stage('simbad', names=len(names)):
+        table = _simbad.query_objects(names)
+    found = dict.fromkeys(names)
+    if table is None:
+        return found
+
+    #  Newer astroquery has lower case columns in degrees, older versions have upper case sexagesimal columns.
+    columns = {column.lower(): column for column in table.colnames}
+    number_column = columns.get('object_number_id', columns.get('script_number_id'))
+    ra_column, dec_column, id_column = columns['ra'], columns['dec'], columns['main_id']
+    sexagesimal = table[ra_column].dtype.kind in 'SUO'
+
+    for row_number, row in enumerate(table):
+        index = int(row[number_column]) - 1 if number_column else row_number
+        ra, dec = row[ra_column], row[dec_column]
+        if index >= len(names) or found[names[index]] is not None:
+            continue
+        if np.ma.is_masked(ra) or str(ra).strip() == '':
+            continue
+
+        if sexagesimal:
+            coord = SkyCoord(str(ra), str(dec), unit=(u.hourangle, u.deg))
+            ra, dec = coord.ra.deg, coord.dec.deg
+        found[names[index]] = {'name': names[index], 'main_id': str(row[id_column]).strip(),
+                               'ra': float(ra), 'dec': float(dec)}
+    return found
+
+
+def resolve(names, cache=None, chunk_size=CHUNK_SIZE):
+    """
+    Resolves a list of target names to coordinates.
+
+    Args:
+        names (list): Target names.
+        cache (NameCache, optional): Names found here aren't sent to SIMBAD, and new answers are stored in it.
+        chunk_size (int, optional): Most names sent to SIMBAD in one query.
+
+    Returns:
+        dict: Maps every name to a dict with name, main_id, ra and dec ( degrees ), or None if SIMBAD didn't
+        find it.
+    """
+    results = {}
+    for name in names:
+        target = cache.get(name) if cache is not None else None
+        if target is not None:
+            results[name] = target
+    if cache is not None:
+        metrics.count('name_cache_hits', len(results))
+
+    #  Every name that isn't cached, once, in the order given.
+    missing = [name for name in dict.fromkeys(names) if name not in results]
+
+    for start in range(0, len(missing), chunk_size):
+        found = query_simbad(missing[start:start + chunk_size])
+        results.update(found)
+        if cache is not None:
+            cache.put([target for target in found.values() if target is not None])
+
+    return {name: results[name] for name in names}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resolve target names to RA and Dec with SIMBAD.')
+    parser.add_argument('names', nargs='*', help='Target names.')
+    parser.add_argument('--file', help='Text file with one target name per line.')
+    parser.add_argument('--no-cache', action='store_true', help='Always ask SIMBAD, ignoring cached answers.')
+    args = parser.parse_args(argv)
+
+    names = list(args.names)
+    if args.file:
+        with open(args.file) as f:
+            names += [line.strip() for line in f if line.strip()]
+    if not names:
+        parser.error('give some target names or --file')
+
+    results = resolve(names, cache=None if args.no_cache else NameCache())
+    writer = csv.DictWriter(sys.stdout, fieldnames=COLUMNS)
+    writer.writeheader()
+    for name in names:
+        writer.writerow(results[name] or {'name': name})
+
+    # * Non-zero exit code if any name couldn't be resolved.
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+"""
+Plate solving for a time series of frames. Frames from the same pointing share nearly the same WCS, so only a
+reference frame is solved. Every other frame is cross-correlated against it to measure how far the stars moved,
+and gets the reference WCS shifted by that amount. Only frames that moved further than a threshold ( or that
+can't be matched ) are solved for real, and they become the reference for the frames after them.
+
+Usage:
+    python series.py /path/to/night --max-shift 50
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+from astropy.io import fits
+from astropy.time import Time
+from cache import SolutionCache
+from coords import header_radec, read_header
+from journal import SubmissionJournal
+from solve import find_images, solve_image, write_wcs
+from solvers import FITS_EXTENSIONS
+from sources import image_hdu
+
+# * Frames further apart than this ( degrees ) are a different pointing.
+POINTING_TOLERANCE = 0.1
+
+# * Frames that moved more than this ( pixels ) from their reference are solved for real.
+MAX_SHIFT = 50.0
+
+# * Size of the central region used for the cross-correlation, and the weakest correlation peak that counts as
+# * a match ( in standard deviations of the correlation surface ).
+CORRELATION_SIZE = 1024
+MIN_PEAK_SIGNIFICANCE = 10.0
+
+# * Header keywords for the longitude of the observatory ( degrees east ), in the order they are tried.
+LONGITUDE_KEYS = ('SITELONG', 'LONG-OBS', 'OBSGEO-L')
+
+
+def site_longitude(header):
+    """ Longitude of the observatory in degrees east ( -180 - 180 ), or None if the header doesn't say. """
+    for key in LONGITUDE_KEYS:
+        value = header.get(key)
+        if value is None or str(value).strip() == '':
+            continue
+        try:
+            #  Capture programs write it as a number or as text like '-105 30 00'.
+            angle = Angle(value if isinstance(value, (int, float)) else str(value).strip(), unit=u.deg)
+        except ValueError:
+            continue
+        return float(angle.wrap_at(180 * u.deg).deg)
+    return None
+
+
+def night_of(header):
+    """
+    Night a frame was taken in, as the date of the local noon before it. The UTC date changes in the middle of
+    the night for most observers, which would split one night's series in two.
+
+    Local noon comes from the observatory longitude in the header, or is taken to be 12:00 UTC without one.
+
+    Returns:
+        str: YYYY-MM-DD of the evening the night began, or the start of DATE-OBS if it can't be read.
+    """
+    date_obs = str(header.get('DATE-OBS', '')).strip()
+    try:
+        taken = Time(date_obs, scale='utc')
+    except ValueError:
+        return date_obs[:10]
+    hours = (site_longitude(header) or 0.0) / 15 - 12
+    return (taken + hours * u.hour).strftime('%Y-%m-%d')
+
+
+def group_frames(image_paths, tolerance=POINTING_TOLERANCE):
+    """
+    Groups frames by pointing.
+
+    Frames are in the same group if they have the same OBJECT, were taken in the same night ( see night_of() ) and
+    point within tolerance degrees of the first frame of the group. Frames are sorted by DATE-OBS inside every group.
+
+    Returns:
+        list: Lists of frame paths, one list per pointing.
+    """
+    groups = []
+    for image_path in image_paths:
+        header = read_header(image_path)
+        date_obs = str(header.get('DATE-OBS', ''))
+        pointing = header_radec(header)
+        key = (str(header.get('OBJECT', '')).strip(), night_of(header))
+
+        for group in groups:
+            if group['key'] != key:
+                continue
+            if pointing is None or group['pointing'] is None:
+                if pointing is group['pointing']:
+                    break
+                continue
+            if pointing.separation(group['pointing']).deg <= tolerance:
+                break
+        else:
+            group = {'key': key, 'pointing': pointing, 'frames': []}
+            groups.append(group)
+        group['frames'].append((date_obs, image_path))
+
+    return [[image_path for _, image_path in sorted(group['frames'])] for group in groups]
+
+
+def correlation_region(image_path, size=CORRELATION_SIZE):
+    """ Background subtracted, windowed central region of a frame, ready for cross-correlation. """
+    #  No explicit memmap=True, it makes astropy refuse scaled data like the uint16 frames most cameras write.
+    with fits.open(image_path) as hdul:
+        data = image_hdu(hdul, image_path).data
+        ny, nx = data.shape
+        hy, hx = min(size, ny) // 2, min(size, nx) // 2
+        region = np.array(data[ny // 2 - hy:ny // 2 + hy, nx // 2 - hx:nx // 2 + hx], dtype=np.float32)
+
+    # * Keeps only what sticks out of the sky, and fades the edges out so they don't correlate with each other.
+    region = np.clip(region - np.median(region), 0, None)
+    window = np.outer(np.hanning(region.shape[0]), np.hanning(region.shape[1])).astype(np.float32)
+    return region * window
+
+
+def measure_shift(reference, frame):
+    """
+    Measures how far the stars moved between two frames with phase correlation.
+
+    Args:
+        reference (numpy.ndarray): Region of the reference frame from correlation_region().
+        frame (numpy.ndarray): Same region of the other frame.
+
+    Returns:
+        tuple: ( dx, dy, significance ). A star at ( x, y ) in the reference is at ( x + dx, y + dy ) in the
+        frame. significance is the height of the correlation peak in standard deviations.
+    """
+    cross_power = np.fft.rfft2(frame) * np.conj(np.fft.rfft2(reference))
+    cross_power /= np.abs(cross_power) + 1e-12
+    surface = np.fft.irfft2(cross_power, s=frame.shape)
+
+    peak_y, peak_x = np.unravel_index(np.argmax(surface), surface.shape)
+    significance = (surface[peak_y, peak_x] - surface.mean()) / (surface.std() + 1e-12)
+
+    # * Refines the peak to a fraction of a pixel with a parabola through it and its neighbours.
+    ny, nx = surface.shape
+
+    def refine(minus, center, plus):
+        denominator = minus - 2 * center + plus
+        return 0.5 * (minus - plus) / denominator if denominator else 0.0
+
+    dy = peak_y + refine(surface[(peak_y - 1) % ny, peak_x], surface[peak_y, peak_x],
+                         surface[(peak_y + 1) % ny, peak_x])
+    dx = peak_x + refine(surface[peak_y, (peak_x - 1) % nx], surface[peak_y, peak_x],
+                         surface[peak_y, (peak_x + 1) % nx])
+
+    #  Peaks past the middle are negative shifts that wrapped around.
+    if dy > ny / 2:
+        dy -= ny
+    if dx > nx / 2:
+        dx -= nx
+    return float(dx), float(dy), float(significance)
+
+
+def shifted_wcs(wcs_header, dx, dy, reference_path):
+    """ Copy of a WCS header moved by ( dx, dy ) pixels. """
+    header = wcs_header.copy()
+    header['CRPIX1'] = header['CRPIX1'] + dx
+    header['CRPIX2'] = header['CRPIX2'] + dy
+    header.add_history(f'WCS propagated from {os.path.basename(reference_path)}, '
+                       f'shifted by ({dx:.2f}, {dy:.2f}) pixels')
+    return header
+
+
+def _region_or_none(image_path):
+    #  A frame that can't be read here gets a real solve, which reports what is wrong with it.
+    try:
+        return correlation_region(image_path)
+    except Exception:
+        return None
+
+
+def solve_series(image_paths, max_shift=MAX_SHIFT, tolerance=POINTING_TOLERANCE, on_result=None, **solve_kwargs):
+    """
+    Solves a time series of frames, solving only the frames that need it.
+
+    Args:
+        image_paths (list): FITS frames of the series.
+        max_shift (float, optional): Frames that moved more than this many pixels are solved for real.
+        tolerance (float, optional): Frames pointing further apart than this many degrees are separate groups.
+        on_result (callable, optional): Called as on_result(image_path, wcs_path, method) for every frame.
+        **solve_kwargs: Passed to solve.solve_image() for the frames that are solved.
+
+    Returns:
+        dict: Maps every frame to ( WCS header path or None, method ), where method is 'solved', 'propagated'
+        or 'failed'.
+    """
+    results = {}
+
+    def finish(image_path, wcs_path, method):
+        results[image_path] = (wcs_path, method)
+        if on_result:
+            on_result(image_path, wcs_path, method)
+
+    for frames in group_frames(image_paths, tolerance):
+        reference_path = reference_header = reference_region = None
+
+        for image_path in frames:
+            if reference_region is not None:
+                region = _region_or_none(image_path)
+                if region is not None and region.shape == reference_region.shape:
+                    dx, dy, significance = measure_shift(reference_region, region)
+                    if significance >= MIN_PEAK_SIGNIFICANCE and np.hypot(dx, dy) <= max_shift:
+                        header = shifted_wcs(reference_header, dx, dy, reference_path)
+                        finish(image_path, write_wcs(header, image_path), 'propagated')
+                        continue
+
+            # * No reference yet, moved too far or couldn't be matched, so it gets a real solve.
+            try:
+                wcs_header = solve_image(image_path, **solve_kwargs)
+            except Exception:
+                #  One bad frame ( or a solve that timed out ) mustn't stop the rest of the night.
+                wcs_header = None
+            if not wcs_header:
+                finish(image_path, None, 'failed')
+                continue
+            finish(image_path, write_wcs(wcs_header, image_path), 'solved')
+            region = _region_or_none(image_path)
+            if region is not None:
+                reference_path, reference_header, reference_region = image_path, wcs_header, region
+
+    return results
+
+
+def print_result(image_path, wcs_path, method):
+    """ Prints one line per finished frame. """
+    print(f'{method.upper():<11} {image_path}' + (f' -> {wcs_path}' if wcs_path else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plate solve a time series, reusing the WCS between frames.')
+    parser.add_argument('directory', help='Directory holding the FITS frames.')
+    parser.add_argument('--max-shift', type=float, default=MAX_SHIFT,
+                        help=f'Frames that moved more than this many pixels are solved ( default: {MAX_SHIFT} ).')
+    parser.add_argument('--tolerance', type=float, default=POINTING_TOLERANCE,
+                        help=f'Degrees between separate pointings ( default: {POINTING_TOLERANCE} ).')
+    parser.add_argument('--extract', action='store_true',
+                        help='Find stars locally and upload only their positions instead of whole images.')
+    args = parser.parse_args(argv)
+
+    frames = [path for path in find_images(args.directory) if path.lower().endswith(FITS_EXTENSIONS)]
+    results = solve_series(frames, max_shift=args.max_shift, tolerance=args.tolerance, on_result=print_result,
+                           cache=SolutionCache(), journal=SubmissionJournal(), extract=args.extract)
+
+    methods = [method for _, method in results.values()]
+    print(f'\n{methods.count("solved")} solved, {methods.count("propagated")} propagated, '
+          f'{methods.count("failed")} failed.')
+    return 0 if 'failed' not in methods else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
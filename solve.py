@@ -0,0 +1,133 @@
+"""
+Non-interactive plate solving helpers. These are the pieces of FITSUploader that don't need a person
+sitting at the keyboard, so they can be shared by the interactive script and the batch mode.
+"""
+
+import os
+import tempfile
+import metrics
+from cache import image_hash
+from hints import for_upload, solve_hints
+from solvers import API_KEY, SOLVE_TIMEOUT, AstrometryNetSolver
+
+# * Supported file extensions (mainly those just supported by astrometry.net)
+FILE_EXTENSIONS = ('.FITS', '.JPEG', '.PNG', '.FIT', '.fits', '.fit', '.fts')
+
+
+def find_images(directory):
+    """
+    Finds every supported image in a directory without asking any questions.
+
+    Args:
+        directory (str): Directory to look in.
+
+    Returns:
+        list: Sorted paths of every file ending in one of FILE_EXTENSIONS.
+    """
+    return sorted(
+        os.path.join(directory, file_name) for file_name in os.listdir(directory)
+        if file_name.endswith(FILE_EXTENSIONS) and os.path.isfile(os.path.join(directory, file_name)))
+
+
+def wcs_path_for(image_path):
+    """ Path of the WCS header that sits next to an image ( /a/b/frame.fits -> /a/b/frame.wcs ). """
+    return os.path.splitext(image_path)[0] + '.wcs'
+
+
+def solve_image(image_path, api_key=API_KEY, solve_timeout=SOLVE_TIMEOUT, cache=None, journal=None,
+                extract=False, solver=None, preprocess=None, hints=None, key=None, target_lookup=None):
+    """
+    Plate solves an image, by default on nova.astrometry.net.
+
+    Args:
+        image_path (str): Path to the image that should be solved.
+        api_key (str, optional): nova.astrometry.net API key, used when no solver is given.
+        solve_timeout (int, optional): Seconds to wait for the solve.
+        cache (cache.SolutionCache, optional): If given, a cached solution of the same pixel data is returned
+            without uploading anything, and new solutions are stored in it.
+        journal (journal.SubmissionJournal, optional): If given, the submission ID is written to it as soon as
+            the upload returns, and an unfinished submission of the same pixel data is monitored again
+            instead of being uploaded.
+        extract (bool, optional): Upload only the positions of the brightest stars instead of the whole image.
+        solver (solvers.Solver, optional): Solver backend, defaults to an AstrometryNetSolver.
+        preprocess (preprocess.Preprocessor, optional): Shrinks the image before it is uploaded. The solution is
+            mapped back onto the original image.
+        hints (bool or dict, optional): Narrows the search to the pointing and plate scale. True reads them from
+            the FITS header ( see hints.py ), a dict is used as it is. A hinted solve that fails is tried again
+            blind, in case the header was wrong.
+        key (str, optional): image_hash() of the image, if the caller already has it.
+        target_lookup (hints.TargetLookup, optional): SIMBAD lookups for hints, shared by every frame of a run.
+
+    Returns:
+        astropy.io.fits.Header: WCS header of the solution, or an empty result if the solve failed.
+    """
+    if key is None and (cache is not None or journal is not None):
+        key = image_hash(image_path)
+
+    # * Same pixel data has been solved before, no need to upload it again.
+    if cache is not None:
+        wcs_header = cache.get(key)
+        metrics.count('cache_misses' if wcs_header is None else 'cache_hits')
+        if wcs_header is not None:
+            return wcs_header
+
+    if solver is None:
+        solver = AstrometryNetSolver(api_key)
+
+    with tempfile.TemporaryDirectory(prefix='autoastrometry-upload-') as upload_dir:
+        upload_path, transform = image_path, None
+        if preprocess is not None:
+            upload_path, transform = preprocess.prepare(image_path, upload_dir)
+
+        settings = solve_hints(image_path, lookup=target_lookup) if hints is True else dict(hints or {})
+        if transform is not None:
+            settings = for_upload(settings, transform.factor)
+
+        wcs_header = _solve_upload(solver, image_path, upload_path, transform, key, journal, solve_timeout, extract,
+                                   settings)
+        if not wcs_header and settings:
+            # * Wrong hints ( a stale pointing, a different camera ) keep the solver from ever finding the field.
+            metrics.count('blind_retries')
+            wcs_header = _solve_upload(solver, image_path, upload_path, transform, key, journal, solve_timeout,
+                                       extract, None)
+
+    if transform is not None:
+        wcs_header = transform.to_original(wcs_header)
+
+    if wcs_header and cache is not None:
+        cache.put(key, wcs_header)
+    return wcs_header
+
+
+def _solve_upload(solver, image_path, upload_path, transform, key, journal, solve_timeout, extract, settings):
+    if solver.has_submissions and journal is not None:
+        #  Shrunk uploads are journaled with their transform, so a resumed solution can be mapped back too.
+        journal_key = key if transform is None else f'{key}:{transform.signature()}'
+
+        # * Picks up a submission left behind by an earlier run that was interrupted.
+        submission_id = journal.pending_submission(journal_key)
+        if not submission_id:
+            submission_id = solver.submit(upload_path, extract, settings)
+            journal.record(journal_key, image_path, submission_id)
+
+        wcs_header = solver.monitor(submission_id, solve_timeout)
+        journal.finish(journal_key, bool(wcs_header))
+        return wcs_header
+    return solver.solve(upload_path, solve_timeout, extract, settings)
+
+
+def write_wcs(wcs_header, image_path):
+    """
+    Writes a solved WCS header next to its source image.
+
+    Args:
+        wcs_header (astropy.io.fits.Header): Header returned by the solve.
+        image_path (str): Path to the image the header belongs to.
+
+    Returns:
+        str: Path the header was written to.
+    """
+    wcs_path = wcs_path_for(image_path)
+    with metrics.stage('fits_write', image=image_path):
+        wcs_header.tofile(wcs_path, overwrite=True)
+    return wcs_path
@@ -0,0 +1,217 @@
+"""
+Plate solver backends. Every backend takes an image path and returns the WCS header of the solution as an
+astropy.io.fits.Header ( or an empty result if the solve failed ), so the rest of the code doesn't care whether
+the image was solved on nova.astrometry.net or on this machine.
+
+    AstrometryNetSolver  nova.astrometry.net through astroquery ( the default ).
+    LocalSolver          A local astrometry.net installation ( solve-field ) and index files on disk.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from astropy.io import fits
+from astroquery.astrometry_net import AstrometryNet
+from astroquery.exceptions import TimeoutError as AstroqueryTimeout
+import metrics
+from sources import extract_from_file
+
+# * Default nova.astrometry.net API key, can be overridden with the ASTROMETRY_NET_API_KEY environment variable.
+API_KEY = os.environ.get('ASTROMETRY_NET_API_KEY', 'bchkvzadjuswddhg')
+
+# * nova.astrometry.net, can be pointed somewhere else ( a local mirror or a test server ) with ASTROMETRY_NET_URL.
+ASTROMETRY_NET_URL = os.environ.get('ASTROMETRY_NET_URL', 'http://nova.astrometry.net').rstrip('/')
+
+# * Seconds to wait on a single solve before giving up.
+SOLVE_TIMEOUT = 1000
+
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts')
+
+
+class Solver():
+    """
+    Base class of the solver backends.
+
+    Backends that hand out submission IDs ( uploads that are solved somewhere else ) set has_submissions and
+    implement submit() and monitor(), which lets solve.solve_image() journal them. Every backend implements solve().
+    """
+
+    name = None
+    has_submissions = False
+
+    def solve(self, image_path, solve_timeout=SOLVE_TIMEOUT, extract=False, settings=None):
+        """
+        Solves an image and waits for the result.
+
+        Args:
+            image_path (str): Path to the image that should be solved.
+            solve_timeout (int, optional): Seconds to wait for the solve.
+            extract (bool, optional): Extract the stars locally and solve from their positions.
+            settings (dict, optional): nova.astrometry.net style solve settings ( center_ra, center_dec, radius,
+                scale_units, scale_lower, scale_upper, ... ), see hints.py.
+
+        Returns:
+            astropy.io.fits.Header: WCS header of the solution, or an empty result if the solve failed.
+        """
+        raise NotImplementedError
+
+    def submit(self, image_path, extract=False, settings=None):
+        """ Starts a solve and returns its submission ID. """
+        raise NotImplementedError
+
+    def monitor(self, submission_id, solve_timeout=SOLVE_TIMEOUT):
+        """ Waits for a submission from submit() and returns its WCS header. """
+        raise NotImplementedError
+
+
+class AstrometryNetSolver(Solver):
+    """ Solves images on nova.astrometry.net. """
+
+    name = 'astrometry.net'
+    has_submissions = True
+
+    def __init__(self, api_key=API_KEY, url=ASTROMETRY_NET_URL):
+        #  Creating instance of astrometry.net and API key
+        self.ast = AstrometryNet()
+        self.ast.api_key = api_key
+        self.ast.URL = url
+        self.ast.API_URL = f'{url}/api'
+        #  Always upload the file itself. With photutils installed astroquery would otherwise find the stars with
+        #  its own ( deprecated ) code, and asking for the upload with force_image_upload is deprecated as well.
+        self.ast._no_source_detector = True
+
+    def submit(self, image_path, extract=False, settings=None):
+        """
+        Uploads an image and returns as soon as nova.astrometry.net has accepted it.
+
+        Args:
+            image_path (str): Path to the image that should be solved.
+            extract (bool, optional): Find the stars locally and upload only their positions instead of the
+                whole image. Only used for FITS files.
+            settings (dict, optional): Solve settings passed along with the upload, see Solver.solve().
+
+        Returns:
+            int: Submission ID to hand to monitor().
+        """
+        settings = settings or {}
+        with metrics.stage('upload', image=image_path, extract=extract, hinted=bool(settings)) as fields:
+            try:
+                #  A zero timeout makes astroquery give up waiting right after the upload, handing back the
+                #  submission ID. astroquery still sleeps for one second first, which shows up in this stage.
+                if extract and image_path.lower().endswith(FITS_EXTENSIONS):
+                    x, y, width, height = extract_from_file(image_path)
+                    _, submission_id = self.ast.solve_from_source_list(x, y, width, height, solve_timeout=0,
+                                                                       return_submission_id=True, verbose=False,
+                                                                       **settings)
+                else:
+                    _, submission_id = self.ast.solve_from_image(f'{image_path}', solve_timeout=0,
+                                                                 return_submission_id=True, verbose=False,
+                                                                 **settings)
+            except AstroqueryTimeout as e:
+                submission_id = e.args[1]
+            fields['submission_id'] = submission_id
+        metrics.count('submissions')
+        return submission_id
+
+    def monitor(self, submission_id, solve_timeout=SOLVE_TIMEOUT):
+        """
+        Waits for a submission to finish.
+
+        Args:
+            submission_id (int): Submission ID from submit().
+            solve_timeout (int, optional): Seconds to wait for the solve.
+
+        Returns:
+            astropy.io.fits.Header: WCS header of the solution, or an empty result if the solve failed.
+
+        Raises:
+            TimeoutError: The submission was still running after solve_timeout seconds. Its journal entry stays
+                pending, so journal.resume_pending() can pick it up later.
+        """
+        try_again = True
+        deadline = time.monotonic() + solve_timeout
+
+        #  astroquery polls, solves and downloads the WCS in one call, so all of it is timed as the solve stage.
+        with metrics.stage('solve', submission_id=submission_id) as fields:
+            while try_again:
+                try:
+                    #  Time is in seconds.
+                    wcs_header = self.ast.monitor_submission(
+                        submission_id, solve_timeout=max(deadline - time.monotonic(), 0), verbose=False)
+                except AstroqueryTimeout as e:
+                    metrics.count('timeouts')
+                    if time.monotonic() >= deadline:
+                        fields['solved'] = False
+                        raise TimeoutError('Solve timed out without success or failure', submission_id) from e
+                    #  Keeps waiting on the same submission instead of uploading the image again.
+                    submission_id = e.args[1]
+                else:
+                    #! got a result, so terminate
+                    try_again = False
+            fields['solved'] = bool(wcs_header)
+
+        return wcs_header
+
+    def solve(self, image_path, solve_timeout=SOLVE_TIMEOUT, extract=False, settings=None):
+        return self.monitor(self.submit(image_path, extract, settings), solve_timeout)
+
+
+class LocalSolver(Solver):
+    """
+    Solves images with a local astrometry.net installation, no network needed.
+
+    solve-field does its own source extraction, so extract is ignored. Every solve is a separate process, which
+    means a batch run with several workers is spread over several cores.
+    """
+
+    name = 'local'
+
+    def __init__(self, solve_field='solve-field', config=None, extra_args=()):
+        """
+        Args:
+            solve_field (str, optional): Name or path of the solve-field executable.
+            config (str, optional): astrometry.cfg that lists the index file directories.
+            extra_args (tuple, optional): Any other solve-field arguments.
+        """
+        if shutil.which(solve_field) is None:
+            raise FileNotFoundError(f'{solve_field} was not found, is astrometry.net installed?')
+        self.solve_field = solve_field
+        self.config = config
+        self.extra_args = tuple(extra_args)
+
+    def solve(self, image_path, solve_timeout=SOLVE_TIMEOUT, extract=False, settings=None):
+        with tempfile.TemporaryDirectory(prefix='autoastrometry-') as out_dir:
+            wcs_file = os.path.join(out_dir, 'solution.wcs')
+            command = [self.solve_field, image_path, '--dir', out_dir, '--wcs', wcs_file,
+                       '--cpulimit', str(solve_timeout), '--overwrite', '--no-plots', '--new-fits', 'none']
+            if self.config:
+                command += ['--config', self.config]
+            command += solve_field_args(settings or {})
+            command += list(self.extra_args)
+
+            with metrics.stage('solve', image=image_path, solver=self.name):
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+            # * solve-field only writes the WCS file when it found a solution.
+            if not os.path.exists(wcs_file):
+                return {}
+            return fits.getheader(wcs_file)
+
+
+def solve_field_args(settings):
+    """ solve-field arguments for nova.astrometry.net style solve settings. """
+    args = []
+    if 'center_ra' in settings and 'center_dec' in settings:
+        args += ['--ra', str(settings['center_ra']), '--dec', str(settings['center_dec']),
+                 '--radius', str(settings.get('radius', 5))]
+    if 'scale_lower' in settings and 'scale_upper' in settings:
+        args += ['--scale-units', settings.get('scale_units', 'arcsecperpix'),
+                 '--scale-low', str(settings['scale_lower']), '--scale-high', str(settings['scale_upper'])]
+    return args
+
+
+# * Backends by name, for command line options.
+SOLVERS = {solver.name: solver for solver in (AstrometryNetSolver, LocalSolver)}
+
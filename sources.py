@@ -0,0 +1,133 @@
+"""
+Local source extraction. Finds the brightest stars in a FITS image with plain NumPy, so only their x / y
+positions need to be sent to nova.astrometry.net instead of the whole image.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+# * Defaults for the extraction.
+N_BRIGHTEST = 200
+DETECT_THRESHOLD = 5.0
+BACKGROUND_BOX = 64
+
+
+def background(data, box=BACKGROUND_BOX):
+    """
+    Estimates the sky background and its noise.
+
+    The image is cut into box x box tiles and the median of every tile is taken in one vectorized call, which
+    keeps stars from pulling the background up. The tile medians are then spread back over the full image.
+
+    Args:
+        data (numpy.ndarray): 2D image data.
+        box (int, optional): Size of the tiles in pixels.
+
+    Returns:
+        tuple: ( background image, noise ) where noise is a single robust standard deviation.
+    """
+    ny, nx = data.shape
+    ty, tx = max(ny // box, 1), max(nx // box, 1)
+
+    #  Crops to a whole number of tiles and reshapes so every tile is one row of a 2D array.
+    tiles = data[:ty * (ny // ty), :tx * (nx // tx)].reshape(ty, ny // ty, tx, nx // tx)
+    tiles = tiles.transpose(0, 2, 1, 3).reshape(ty, tx, -1)
+    medians = np.median(tiles, axis=2)
+
+    # * Nearest tile value for every pixel ( pixels past the last whole tile use the last tile ).
+    rows = np.minimum(np.arange(ny) // (ny // ty), ty - 1)
+    cols = np.minimum(np.arange(nx) // (nx // tx), tx - 1)
+    sky = medians[rows[:, None], cols[None, :]]
+
+    #  Median absolute deviation scaled to a standard deviation.
+    residual = data - sky
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual)))
+    return sky, noise
+
+
+def find_peaks(data, threshold):
+    """
+    Finds local maxima above a threshold.
+
+    Args:
+        data (numpy.ndarray): Background subtracted 2D image data.
+        threshold (float): Minimum peak value.
+
+    Returns:
+        tuple: ( y, x ) integer positions of the peaks.
+    """
+    #  A pixel is a peak if it is above the threshold and not smaller than any of its 8 neighbours.
+    padded = np.pad(data, 1, mode='constant', constant_values=-np.inf)
+    center = padded[1:-1, 1:-1]
+    is_peak = center > threshold
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                is_peak &= center >= padded[1 + dy:padded.shape[0] - 1 + dy, 1 + dx:padded.shape[1] - 1 + dx]
+    return np.nonzero(is_peak)
+
+
+def extract_sources(data, n_brightest=N_BRIGHTEST, threshold=DETECT_THRESHOLD, box=BACKGROUND_BOX):
+    """
+    Finds the brightest sources in an image.
+
+    Args:
+        data (numpy.ndarray): 2D image data.
+        n_brightest (int, optional): Number of sources to keep.
+        threshold (float, optional): Detection threshold in multiples of the background noise.
+        box (int, optional): Background tile size in pixels.
+
+    Returns:
+        tuple: ( x, y, flux ) arrays sorted brightest first. Positions are 0 indexed and centroided over the
+        3 x 3 pixels around every peak.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    sky, noise = background(data, box)
+    data = data - sky
+
+    y, x = find_peaks(data, threshold * noise)
+
+    #  Sources right on the edge can't be centroided.
+    ny, nx = data.shape
+    keep = (y > 0) & (y < ny - 1) & (x > 0) & (x < nx - 1)
+    y, x = y[keep], x[keep]
+
+    # * Sums and flux weighted offsets of the 3 x 3 box around every peak, all peaks at once.
+    offsets = np.array([-1, 0, 1])
+    stamps = data[y[:, None, None] + offsets[None, :, None], x[:, None, None] + offsets[None, None, :]]
+    stamps = np.clip(stamps, 0, None)
+    flux = stamps.sum(axis=(1, 2))
+    safe_flux = np.where(flux > 0, flux, 1)
+    yc = y + (stamps.sum(axis=2) * offsets).sum(axis=1) / safe_flux
+    xc = x + (stamps.sum(axis=1) * offsets).sum(axis=1) / safe_flux
+
+    brightest = np.argsort(flux)[::-1][:n_brightest]
+    return xc[brightest], yc[brightest], flux[brightest]
+
+
+def image_hdu(hdul, image_path=''):
+    """ First HDU of an open FITS file that holds a 2D image. """
+    #  Picked from the headers alone, touching .data would read in every HDU before the image.
+    for hdu in hdul:
+        header = hdu.header
+        if hdu.is_image and header.get('NAXIS') == 2 and header.get('NAXIS1', 0) > 0 and header.get('NAXIS2', 0) > 0:
+            return hdu
+    raise ValueError(f'{image_path} has no 2D image.')
+
+
+def extract_from_file(image_path, n_brightest=N_BRIGHTEST, threshold=DETECT_THRESHOLD):
+    """
+    Finds the brightest sources in the first image HDU of a FITS file.
+
+    Returns:
+        tuple: ( x, y, width, height ) ready for AstrometryNet.solve_from_source_list().
+    """
+    #  No explicit memmap=True, astropy can only map data that needs no scaling ( BZERO / BSCALE / BLANK ), and
+    #  most cameras write uint16 with BZERO = 32768. It still maps the data whenever it can.
+    with fits.open(image_path) as hdul:
+        hdu = image_hdu(hdul, image_path)
+        height, width = hdu.data.shape
+        x, y, _ = extract_sources(hdu.data, n_brightest, threshold)
+
+    #  astrometry.net positions are 1 indexed.
+    return x + 1, y + 1, width, height
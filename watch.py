@@ -0,0 +1,341 @@
+"""
+Watch mode for the telescope: solves frames as the camera writes them.
+
+A directory is polled for new images. A frame is taken once its size and modification time have stopped changing
+for a moment ( and, for FITS, it is a whole number of 2880 byte blocks ), so half written files are never uploaded.
+Frames then go through a pipeline of threads joined by bounded queues:
+
+    scan -> hash + cache check -> solve ( several workers ) -> WCS write + target pixel coordinates
+
+When the solvers fall behind the queues fill up and scanning pauses, so a burst of frames waits on disk instead of
+piling up in memory. Frames that already have an up to date .wcs next to them, or were handled earlier in the run,
+are skipped.
+
+Usage:
+    python watch.py /data/tonight --target "V1405 Cas" --hints
+    python watch.py /data/tonight --targets stars.csv --output pixels.csv --solver local --workers 4
+"""
+
+import argparse
+import csv
+import os
+import queue
+import sys
+import threading
+import time
+import metrics
+from batch import add_preprocess_arguments, preprocessor_from_args, print_result
+from cache import SolutionCache, image_hash
+from coords import COLUMNS, convert_targets, read_targets
+from embed import embed_wcs
+from hints import TargetLookup
+from journal import SubmissionJournal
+from solve import FILE_EXTENSIONS, solve_image, wcs_path_for, write_wcs
+from solvers import FITS_EXTENSIONS, SOLVE_TIMEOUT, SOLVERS, LocalSolver
+
+# * Seconds between directory scans, and how long a file must stay the same size before it counts as written.
+POLL_INTERVAL = 1.0
+SETTLE_SECONDS = 2.0
+
+# * Frames allowed to wait between two pipeline stages before scanning pauses.
+QUEUE_SIZE = 8
+
+# * FITS files are always a whole number of these. A FITS file that isn't, but hasn't changed for this many times
+# * the settle time, is taken anyway so the solve can report what is wrong with it.
+FITS_BLOCK = 2880
+STALE_FACTOR = 10
+
+#  Marks the end of the work in a pipeline queue.
+_DONE = None
+
+
+def is_complete(path, size):
+    """ False for a FITS file that stopped in the middle of a block ( the camera is still writing it ). """
+    return size > 0 and (not path.lower().endswith(FITS_EXTENSIONS) or size % FITS_BLOCK == 0)
+
+
+def has_current_wcs(image_path):
+    """ True if the image already has a .wcs next to it that is newer than the image. """
+    try:
+        return os.path.getmtime(wcs_path_for(image_path)) >= os.path.getmtime(image_path)
+    except OSError:
+        return False
+
+
+class Watcher():
+    """
+    Watches a directory and solves every new frame.
+
+    Args:
+        directory (str): Directory the camera writes to.
+        workers (int, optional): Solves in flight at once.
+        cache (cache.SolutionCache, optional): Solution cache checked before anything is uploaded.
+        journal (journal.SubmissionJournal, optional): Submission journal, so a restart picks up unfinished solves.
+        targets (tuple, optional): ( names, ra, dec ) lists, converted to pixel coordinates on every solved frame.
+        on_result (callable, optional): Called as on_result(image_path, wcs_path, error, rows) for every frame,
+            with rows the target pixel coordinates ( empty without targets or a solution ).
+        interval (float, optional): Seconds between scans.
+        settle (float, optional): Seconds a file must stay unchanged before it is solved.
+        queue_size (int, optional): Frames allowed to wait between two stages.
+        embed (bool, optional): Also write every solution into the header of its FITS file.
+        **solve_kwargs: Passed to solve.solve_image() ( solver, extract, preprocess, hints, solve_timeout, ... ).
+    """
+
+    def __init__(self, directory, workers=2, cache=None, journal=None, targets=None, on_result=None,
+                 interval=POLL_INTERVAL, settle=SETTLE_SECONDS, queue_size=QUEUE_SIZE, embed=False, **solve_kwargs):
+        self.directory = directory
+        self.workers = workers
+        self.cache = cache
+        self.journal = journal
+        self.targets = targets
+        self.on_result = on_result
+        self.interval = interval
+        self.settle = settle
+        self.embed = embed
+        self.solve_kwargs = solve_kwargs
+        if solve_kwargs.get('hints') is True:
+            #  A whole night of frames of the same target costs one SIMBAD lookup.
+            self.solve_kwargs.setdefault('target_lookup', TargetLookup())
+        self.stop_event = threading.Event()
+
+        self._ready = queue.Queue(queue_size)
+        self._to_solve = queue.Queue(queue_size)
+        self._to_write = queue.Queue(queue_size)
+        #  path -> ( size, mtime ) of every frame that was handed to the pipeline.
+        self._seen = {}
+        #  path -> ( size, mtime, time it last changed, time it was first seen ) of frames still being written.
+        self._pending = {}
+
+    def skip_existing(self):
+        """ Marks every frame that already has an up to date .wcs as seen. """
+        for entry in self._frames():
+            if has_current_wcs(entry.path):
+                stat = entry.stat()
+                self._seen[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+    def _frames(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.name.endswith(FILE_EXTENSIONS) and entry.is_file()]
+
+    def scan(self):
+        """
+        Looks at the directory once.
+
+        Returns:
+            list: ( path, time first seen ) of every frame that has finished being written since the last scan.
+        """
+        now = time.monotonic()
+        ready = []
+        frames = self._frames()
+        for entry in frames:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(entry.path) == signature:
+                #  Also drops a frame that only looked changed because its solution was just embedded.
+                self._pending.pop(entry.path, None)
+                continue
+
+            pending = self._pending.get(entry.path)
+            if pending is None or pending[:2] != signature:
+                first_seen = pending[3] if pending else now
+                self._pending[entry.path] = (*signature, now, first_seen)
+            elif now - pending[2] >= self.settle and (is_complete(entry.path, stat.st_size)
+                                                       or now - pending[2] >= self.settle * STALE_FACTOR):
+                del self._pending[entry.path]
+                self._seen[entry.path] = signature
+                ready.append((entry.path, pending[3]))
+
+        #  Frames deleted before they were finished.
+        for path in self._pending.keys() - {entry.path for entry in frames}:
+            del self._pending[path]
+        return sorted(ready)
+
+    def run(self, once=False):
+        """
+        Watches until stop() is called ( or, with once, until every frame already there has been solved ).
+        """
+        threads = [threading.Thread(target=self._hash_stage, name='watch-hash', daemon=True),
+                   threading.Thread(target=self._write_stage, name='watch-write', daemon=True)]
+        threads += [threading.Thread(target=self._solve_stage, name=f'watch-solve-{number}', daemon=True)
+                    for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while not self.stop_event.is_set():
+                for item in self.scan():
+                    #  Blocks while the pipeline is full, which is the backpressure.
+                    self._ready.put(item)
+                if once and not self._pending:
+                    break
+                self.stop_event.wait(self.interval)
+        finally:
+            self._ready.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _hash_stage(self):
+        while True:
+            item = self._ready.get()
+            if item is _DONE:
+                break
+            image_path, first_seen = item
+            if self.cache is None and self.journal is None:
+                #  Nothing would read the hash, so the frame isn't read an extra time for it.
+                self._to_solve.put((image_path, first_seen, None))
+                continue
+            try:
+                key = image_hash(image_path)
+                wcs_header = self.cache.get(key) if self.cache is not None else None
+            except Exception as e:
+                self._to_write.put((image_path, first_seen, None, e))
+                continue
+            if self.cache is not None:
+                metrics.count('cache_misses' if wcs_header is None else 'cache_hits')
+            if wcs_header is not None:
+                # * Same pixel data was solved before, straight on to writing.
+                self._to_write.put((image_path, first_seen, wcs_header, None))
+            else:
+                self._to_solve.put((image_path, first_seen, key))
+
+        for _ in range(self.workers):
+            self._to_solve.put(_DONE)
+
+    def _solve_stage(self):
+        while True:
+            item = self._to_solve.get()
+            if item is _DONE:
+                break
+            image_path, first_seen, key = item
+            wcs_header = error = None
+            try:
+                #  The cache was checked by the hash stage, so the solution is stored here instead.
+                wcs_header = solve_image(image_path, journal=self.journal, key=key, **self.solve_kwargs)
+                if wcs_header and self.cache is not None:
+                    self.cache.put(key, wcs_header)
+            except Exception as e:
+                error = e
+            self._to_write.put((image_path, first_seen, wcs_header, error))
+        self._to_write.put(_DONE)
+
+    def _write_stage(self):
+        running = self.workers
+        while running:
+            item = self._to_write.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            image_path, first_seen, wcs_header, error = item
+            wcs_path, rows = None, []
+            if error is None and wcs_header:
+                try:
+                    if self.embed:
+                        embed_wcs(image_path, wcs_header)
+                        #  The frame changed on disk, but it has been handled, so the scan mustn't take it again.
+                        stat = os.stat(image_path)
+                        self._seen[image_path] = (stat.st_size, stat.st_mtime_ns)
+                    wcs_path = write_wcs(wcs_header, image_path)
+                    if self.targets:
+                        rows = convert_targets(wcs_path, *self.targets)
+                except Exception as e:
+                    error = e
+                # * Time from the first sight of the file to its WCS on disk.
+                metrics.observe('watch_latency', time.monotonic() - first_seen,
+                                error=type(error).__name__ if error else None, image=image_path)
+            if self.on_result:
+                self.on_result(image_path, wcs_path, error, rows)
+
+
+def main(argv=None):
+    from resolver import NameCache, resolve
+
+    parser = argparse.ArgumentParser(description='Solve frames as the camera writes them into a directory.')
+    parser.add_argument('directory', help='Directory to watch.')
+    parser.add_argument('--target', action='append', default=[],
+                        help='Target name to find on every frame ( looked up in SIMBAD once, can be repeated ).')
+    parser.add_argument('--targets', help='CSV with ra and dec columns ( and optionally name ) to find on every frame.')
+    parser.add_argument('--output', help='Append the target pixel coordinates of every frame to this CSV.')
+    parser.add_argument('--workers', type=int, default=2, help='Solves in flight at once ( default: 2 ).')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help=f'Seconds between directory scans ( default: {POLL_INTERVAL} ).')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help=f'Seconds a file must stay unchanged before it is solved ( default: {SETTLE_SECONDS} ).')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help=f'Frames allowed to wait between pipeline stages ( default: {QUEUE_SIZE} ).')
+    parser.add_argument('--timeout', type=int, default=SOLVE_TIMEOUT,
+                        help=f'Seconds to wait on each solve ( default: {SOLVE_TIMEOUT} ).')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the solution cache and submission journal.')
+    parser.add_argument('--extract', action='store_true',
+                        help='Find stars locally and upload only their positions instead of whole images.')
+    parser.add_argument('--solver', choices=sorted(SOLVERS), default='astrometry.net',
+                        help='Solve on nova.astrometry.net or with a local solve-field ( default: astrometry.net ).')
+    parser.add_argument('--solve-field', default='solve-field', help='solve-field executable for --solver local.')
+    parser.add_argument('--config', help='astrometry.cfg listing the index files for --solver local.')
+    parser.add_argument('--hints', action='store_true',
+                        help='Narrow each solve to the pointing and plate scale in the FITS header.')
+    parser.add_argument('--embed', action='store_true',
+                        help='Also write each solution into the header of the original FITS file.')
+    parser.add_argument('--once', action='store_true', help='Solve what is there now and exit instead of watching.')
+    add_preprocess_arguments(parser)
+    args = parser.parse_args(argv)
+
+    names, ra, dec = read_targets(args.targets) if args.targets else ([], [], [])
+    if args.target:
+        found = resolve(args.target, cache=NameCache())
+        missing = [name for name in args.target if not found[name]]
+        if missing:
+            print(f'SIMBAD does not know {", ".join(missing)}')
+            return 1
+        names += args.target
+        ra += [found[name]['ra'] for name in args.target]
+        dec += [found[name]['dec'] for name in args.target]
+
+    output = None
+    if args.output:
+        new_file = not os.path.exists(args.output)
+        output = open(args.output, 'a', newline='', buffering=1)
+        writer = csv.DictWriter(output, fieldnames=('image',) + COLUMNS)
+        if new_file:
+            writer.writeheader()
+
+    def report(image_path, wcs_path, error, rows):
+        print_result(image_path, wcs_path, error)
+        for row in rows:
+            where = '' if row['in_bounds'] else '  ( outside the image )'
+            print(f"        {row['name']}: ({row['x']:.2f}, {row['y']:.2f}){where}")
+            if output:
+                writer.writerow({'image': image_path, **row})
+
+    solver = None
+    if args.solver == 'local':
+        solver = LocalSolver(solve_field=args.solve_field, config=args.config)
+
+    cache = journal = None
+    if not args.no_cache:
+        cache, journal = SolutionCache(), SubmissionJournal()
+    watcher = Watcher(args.directory, workers=args.workers, cache=cache, journal=journal,
+                      targets=(names, ra, dec) if names else None, on_result=report, interval=args.interval,
+                      settle=args.settle, queue_size=args.queue_size, embed=args.embed, solver=solver,
+                      solve_timeout=args.timeout, extract=args.extract, preprocess=preprocessor_from_args(args),
+                      hints=args.hints)
+    watcher.skip_existing()
+    print(f'Watching {args.directory}, Ctrl+C to stop.')
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        #  run() finishes the frames that were already taken before it lets go.
+        print('\nStopped.')
+    finally:
+        if output:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 from rich import print
 import webbrowser
-from astroquery.simbad import Simbad
+from astropy.coordinates import SkyCoord
+from resolver import NameCache, resolve
 
 
 def ask_for(prompt, error_msg=None, _type=None):
@@ -64,8 +65,12 @@ def simbad_query():
 
         # * Asks for target name and tries to look it up then if it can, prints it out.
         target = ask_for('\nTarget name: ')
-        query = Simbad.query_object(f'{target}')
-        query.pprint()
+        target_info = resolve([target], cache=NameCache())[target]
+        if target_info is None:
+            raise LookupError(f'{target} was not found')
+        coord = SkyCoord(target_info['ra'], target_info['dec'], unit='deg')
+        print(f"{target_info['main_id']}  RA: {coord.ra.to_string(unit='hourangle', sep=' ', precision=2)}  "
+              f"Dec: {coord.dec.to_string(sep=' ', precision=1, alwayssign=True)}")
         # * Asks the user if they wanted to be inp.redirect_toed to the website.
         redirect_to('http://simbad.u-strasbg.fr/simbad/sim-fbasic')
     except:
@@ -0,0 +1,297 @@
+"""
+Work queue for spreading plate solves over many machines. A coordinator puts image paths into a SQLite queue on
+shared storage, and any number of stateless workers on any node claim jobs, solve them and write the results back.
+
+Every claimed job has a lease that the worker keeps renewing while it solves. If a worker dies its lease runs out
+and the job goes back in the queue for someone else, so nothing is lost and nothing needs cleaning up by hand.
+
+The queue uses SQLite's normal rollback journal rather than WAL, because WAL doesn't work on network filesystems.
+The shared storage must support file locking ( NFSv4, Lustre, GPFS and CephFS all do ).
+
+Usage:
+    python workqueue.py /shared/queue.sqlite enqueue /shared/night1 /shared/night2
+    python workqueue.py /shared/queue.sqlite work --threads 4        ( on every node )
+    python workqueue.py /shared/queue.sqlite status
+"""
+
+import argparse
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import metrics
+from cache import SolutionCache
+from solve import find_images, solve_image, write_wcs
+from solvers import SOLVE_TIMEOUT, LocalSolver
+
+# * Job states.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# * Seconds a claim lasts without being renewed, and how many times a job is tried before it is marked failed.
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+# * Seconds an idle worker waits before looking for new jobs again ( with --wait ).
+IDLE_WAIT = 10
+
+
+class WorkQueue():
+    """
+    SQLite backed job queue with leases. A new connection is opened for every call, so one queue can be used by
+    many threads, processes and machines at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    image_path TEXT UNIQUE NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_expires REAL,
+                    wcs_path TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL
+                )""")
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+
+    def _connect(self):
+        #  isolation_level=None so transactions are started by hand with BEGIN IMMEDIATE.
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def enqueue(self, image_paths):
+        """
+        Adds images to the queue. Images that are already queued ( in any state ) are skipped.
+
+        Returns:
+            int: Number of jobs added.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (image_path, state, updated) VALUES (?, ?, ?)',
+                           ((os.path.abspath(path), QUEUED, now) for path in image_paths))
+            added = db.total_changes - before
+            db.execute('COMMIT')
+        return added
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """
+        Claims the oldest queued job. Jobs whose lease ran out are put back in the queue first, or marked failed
+        once they have been tried max_attempts times ( a job that keeps killing its worker never reaches fail() ).
+
+        Args:
+            worker (str): Name of the worker claiming the job.
+            lease_seconds (float, optional): How long the claim lasts without renew().
+            max_attempts (int, optional): Tries before a job whose lease ran out is marked failed.
+
+        Returns:
+            tuple: ( job ID, image path ), or None if there is nothing to do.
+        """
+        now = time.time()
+        with self._connect() as db:
+            #  BEGIN IMMEDIATE takes the write lock straight away, so two workers can never claim the same job.
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                       "error = CASE WHEN attempts >= ? THEN 'lease expired' ELSE error END, worker = NULL, "
+                       "lease_expires = NULL, updated = ? WHERE state = ? AND lease_expires < ?",
+                       (max_attempts, FAILED, QUEUED, max_attempts, now, RUNNING, now))
+            row = db.execute('SELECT id, image_path FROM jobs WHERE state = ? ORDER BY id LIMIT 1',
+                             (QUEUED,)).fetchone()
+            if row:
+                db.execute('UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, '
+                           'updated = ? WHERE id = ?', (RUNNING, worker, now + lease_seconds, now, row[0]))
+            db.execute('COMMIT')
+        return row
+
+    def renew(self, job_id, worker, lease_seconds=LEASE_SECONDS):
+        """
+        Extends the lease of a claimed job.
+
+        Returns:
+            bool: False if the job isn't this worker's any more ( its lease ran out and someone else took it ).
+        """
+        with self._connect() as db:
+            cursor = db.execute('UPDATE jobs SET lease_expires = ?, updated = ? '
+                                'WHERE id = ? AND worker = ? AND state = ?',
+                                (time.time() + lease_seconds, time.time(), job_id, worker, RUNNING))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, wcs_path):
+        """ Marks a claimed job as done. Ignored if the job isn't this worker's any more. """
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET state = ?, wcs_path = ?, error = NULL, lease_expires = NULL, updated = ? '
+                       'WHERE id = ? AND worker = ? AND state = ?', (DONE, wcs_path, time.time(), job_id, worker,
+                                                                      RUNNING))
+
+    def fail(self, job_id, worker, error, max_attempts=MAX_ATTEMPTS):
+        """ Puts a job back in the queue, or marks it failed once it has been tried max_attempts times. """
+        with self._connect() as db:
+            db.execute('UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, worker = NULL, '
+                       'lease_expires = NULL, updated = ? WHERE id = ? AND worker = ? AND state = ?',
+                       (max_attempts, FAILED, QUEUED, str(error), time.time(), job_id, worker, RUNNING))
+
+    def requeue_failed(self):
+        """
+        Gives every failed job another round of attempts.
+
+        Returns:
+            int: Number of jobs put back in the queue.
+        """
+        with self._connect() as db:
+            cursor = db.execute('UPDATE jobs SET state = ?, attempts = 0, updated = ? WHERE state = ?',
+                                (QUEUED, time.time(), FAILED))
+        return cursor.rowcount
+
+    def counts(self):
+        """ Number of jobs in every state. """
+        with self._connect() as db:
+            rows = db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0) | dict(rows)
+
+    def failures(self):
+        """ ( image path, error ) of every failed job. """
+        with self._connect() as db:
+            return db.execute('SELECT image_path, error FROM jobs WHERE state = ? ORDER BY id', (FAILED,)).fetchall()
+
+
+def run_worker(queue, worker, lease_seconds=LEASE_SECONDS, wait=False, on_result=None, **solve_kwargs):
+    """
+    Claims and solves jobs until the queue is empty ( or forever, with wait ).
+
+    While a job is being solved a background thread renews its lease every third of the lease time.
+
+    Args:
+        queue (WorkQueue): The shared queue.
+        worker (str): Name of this worker, unique across the cluster.
+        lease_seconds (float, optional): Lease length.
+        wait (bool, optional): Keep waiting for new jobs when the queue is empty.
+        on_result (callable, optional): Called as on_result(image_path, wcs_path, error) for every job.
+        **solve_kwargs: Passed to solve.solve_image().
+
+    Returns:
+        int: Number of jobs this worker finished.
+    """
+    finished = 0
+    while True:
+        job = queue.claim(worker, lease_seconds)
+        if job is None:
+            if not wait:
+                return finished
+            time.sleep(IDLE_WAIT)
+            continue
+
+        job_id, image_path = job
+        solving = threading.Event()
+
+        def heartbeat():
+            while not solving.wait(lease_seconds / 3):
+                if not queue.renew(job_id, worker, lease_seconds):
+                    return
+
+        renewer = threading.Thread(target=heartbeat, daemon=True)
+        renewer.start()
+        wcs_path = error = None
+        try:
+            wcs_header = solve_image(image_path, **solve_kwargs)
+            if not wcs_header:
+                raise RuntimeError('no solution')
+            wcs_path = write_wcs(wcs_header, image_path)
+        except Exception as e:
+            error = e
+        finally:
+            solving.set()
+            renewer.join()
+
+        if error is None:
+            queue.complete(job_id, worker, wcs_path)
+        else:
+            queue.fail(job_id, worker, error)
+        finished += 1
+        if on_result:
+            on_result(image_path, wcs_path, error)
+
+
+def run_workers(queue, threads=1, **kwargs):
+    """
+    Runs several workers in this process, named after the host, process and thread.
+
+    Returns:
+        int: Number of jobs finished by all of them.
+    """
+    finished = []
+    base = f'{socket.gethostname()}:{os.getpid()}'
+
+    def work(number):
+        finished.append(run_worker(queue, f'{base}:{number}', **kwargs))
+
+    workers = [threading.Thread(target=work, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(finished)
+
+
+def main(argv=None):
+    from batch import print_result
+
+    parser = argparse.ArgumentParser(description='Distribute plate solves over many machines.')
+    parser.add_argument('queue', help='Queue file on shared storage.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = commands.add_parser('enqueue', help='Add images ( files or directories ) to the queue.')
+    enqueue.add_argument('paths', nargs='+')
+
+    work = commands.add_parser('work', help='Solve jobs from the queue.')
+    work.add_argument('--threads', type=int, default=1, help='Workers in this process ( default: 1 ).')
+    work.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                      help=f'Seconds a claim lasts without renewal ( default: {LEASE_SECONDS} ).')
+    work.add_argument('--wait', action='store_true', help='Keep waiting for new jobs when the queue is empty.')
+    work.add_argument('--timeout', type=int, default=SOLVE_TIMEOUT, help='Seconds to wait on each solve.')
+    work.add_argument('--extract', action='store_true',
+                      help='Find stars locally and upload only their positions instead of whole images.')
+    work.add_argument('--solver', choices=('astrometry.net', 'local'), default='astrometry.net')
+    work.add_argument('--config', help='astrometry.cfg listing the index files for --solver local.')
+    work.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port while working.')
+
+    commands.add_parser('status', help='Show how many jobs are in every state.')
+    commands.add_parser('requeue-failed', help='Give every failed job another round of attempts.')
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.queue)
+    if args.command == 'enqueue':
+        image_paths = []
+        for path in args.paths:
+            image_paths += find_images(path) if os.path.isdir(path) else [path]
+        print(f'Added {queue.enqueue(image_paths)} of {len(image_paths)} images.')
+    elif args.command == 'work':
+        solver = LocalSolver(config=args.config) if args.solver == 'local' else None
+        if args.metrics_port:
+            metrics.METRICS.serve(args.metrics_port)
+        finished = run_workers(queue, threads=args.threads, lease_seconds=args.lease, wait=args.wait,
+                               on_result=print_result, solve_timeout=args.timeout, extract=args.extract,
+                               solver=solver, cache=SolutionCache())
+        print(f'\nFinished {finished} jobs.')
+    elif args.command == 'requeue-failed':
+        print(f'Requeued {queue.requeue_failed()} jobs.')
+
+    counts = queue.counts()
+    print(', '.join(f'{count} {state}' for state, count in counts.items()))
+    if args.command == 'status':
+        for image_path, error in queue.failures():
+            print(f'FAILED  {image_path}: {error}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())